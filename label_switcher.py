@@ -1,4 +1,10 @@
 import argparse
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from functools import partial
+import hashlib
+import importlib
 import io
 import numpy as np
 import os
@@ -6,18 +12,46 @@ import pandas as pd
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import qrcode
+import shutil
+import signal
 import struct
 import sys
-from .utils.constants import FORMAT_CHARACTERS, TAGNAMES, TYPE_DICT, COMPRESSION
-from .utils.tiffwriter import BigTiffMaker, LabelSaver
-
+import threading
+import time
+from .utils.aperio import parse_image_description
+from .utils.audit import AuditLog, EncryptedArchiveSink, utc_timestamp
+from .utils.constants import BIG_TIFF, CLASSIC_TIFF, CLASSIC_TIFF_MAX_OFFSET, COMPRESSION, FORMAT_CHARACTERS, \
+    TAGNAMES, TYPE_DICT
+from .utils.contact_sheet import ContactSheet
+from .utils.label_cache import LabelCache
+from .utils.labelpack import LabelPackWriter
+from .utils.locking import SlideLock, SlideLockedError
+from .utils.metrics import BYTES_GROWN, BYTES_RECLAIMED, BYTES_WIPED, BYTES_WRITTEN, IN_FLIGHT, LABEL_CACHE_REQUESTS, METRICS, PHASE_SECONDS, \
+    QUEUE_DEPTH, SLIDES
+from .utils.ordering import locality_order
+from .utils.streaming import STREAM_WINDOW, StreamingDeidentifier
+from .utils.tags import LazyTagInfo
+from .utils.tiffwriter import BIG_TIFF_LABEL_TEMPLATE, BigTiffMaker, LabelSaver, RawImageSaver
+from .utils.watcher import FolderWatcher
+
+# bytes read, hashed and overwritten at a time by the fused de-identification
+WIPE_CHUNK_SIZE = 1024 * 1024
+
+LABEL_DIMENSIONS = (609, 567)
+MACRO_DIMENSIONS = (1495, 606)
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+# bump when the rendering or encoding of labels changes to invalidate cached labels
+LABEL_CACHE_VERSION = 1
 
 class BigTiffFile():
     def __init__(self, file_path) -> None:
-        """Reads BigTiff file header and IFD information. The information can be printed for
+        """Reads BigTiff (or classic TIFF) file header and IFD information. The information can be printed for
         informational purposes. Can be used in isolation with de_identify_slide to overwrite 
         the label and macro images in SVS files.
 
+        Only the IFDs are read up front. Tag values ('value' in tiff_info) are decoded when they
+        are first accessed.
+
         Args:
             file_path (str | BytesIO): file path as a string or image as a BytesIO object
         """
@@ -29,49 +63,175 @@ class BigTiffFile():
 
         self._label = None
         self._macro = None
+        self._stream = None
+        # directory: parsed ImageDescription
+        self._descriptions = {}
 
-        #TODO add classic tiff support
         self.endian = None
         self.bigtiff = False
+        # byte layout of the header and IFDs, BIG_TIFF or CLASSIC_TIFF
+        self.layout = None
 
         if isinstance(file_path, io.BytesIO):
             bigtiff = file_path
+            self._stream = bigtiff
             next_offset = self._read_header(bigtiff)
             while next_offset != 0:  
                 next_offset = self._read_IFDs(bigtiff, next_offset)
         else:
-            with open(file_path, 'rb') as bigtiff:
+            with PHASE_SECONDS.time(phase='parse'), open(file_path, 'rb') as bigtiff:
+                self._stream = bigtiff
                 next_offset = self._read_header(bigtiff)
                 while next_offset != 0:  
                     next_offset = self._read_IFDs(bigtiff, next_offset)  
                 self._get_label_and_macro_info()
+            self._stream = None
 
 
-    def de_identify_slide(self):
+    def de_identify_slide(self, audit_log: AuditLog=None, archive: EncryptedArchiveSink=None,
+        chunk_size: int=WIPE_CHUNK_SIZE):
         """Overwrites the macro and label data with 0s.
+
+        If an audit log or archive is given, each strip is streamed once in chunks: every chunk
+        is read, added to a SHA-256 digest and optionally copied to the archive. The archive is
+        flushed to disk before the label or macro is overwritten, so the original bytes are never
+        lost if the process is killed. This gives proof of what was destroyed without a separate
+        read of label_data.
+
+        Args:
+            audit_log (AuditLog, optional): batch audit log to append the slide record to. Defaults to None.
+            archive (EncryptedArchiveSink, optional): sink that keeps an encrypted copy of the
+            original bytes. Defaults to None.
+            chunk_size (int, optional): bytes processed at a time. Defaults to WIPE_CHUNK_SIZE.
+
+        Returns:
+            dict | None: audit record with the offset, size and SHA-256 digest of each wiped
+            region. None if neither an audit log nor an archive is given
         """
-        label_strip_offset = self._label['strip offset']
-        label_byte_count = self._label['strip byte counts']
-        macro_strip_offset = self._macro['strip offset']
-        macro_byte_count = self._macro['strip byte counts']
+        label_strips = self._label['strips']
+        macro_strips = self._macro['strips']
         
         if 'DigitalPathology' in str(self.file_path):
             raise RuntimeError('Cannot remove labels in provided directory!!')
-        
-        with open(self.file_path, 'rb+') as tiff:
-            tiff.seek(label_strip_offset)
-            tiff.write(b'\0' * label_byte_count)
-            tiff.seek(macro_strip_offset)
-            tiff.write(b'\0' * macro_byte_count)
+
+        if audit_log is None and archive is None:
+            with PHASE_SECONDS.time(phase='wipe'), open(self.file_path, 'rb+') as tiff:
+                for strip_offset, byte_count in label_strips + macro_strips:
+                    tiff.seek(strip_offset)
+                    tiff.write(b'\0' * byte_count)
+            BYTES_WIPED.inc(sum(byte_count for _, byte_count in label_strips + macro_strips))
+            return None
+
+        record = {
+            'slide': str(self.file_path),
+            'started': utc_timestamp(),
+            'regions': [],
+            'archived': archive is not None
+        }
+        with PHASE_SECONDS.time(phase='wipe'), open(self.file_path, 'rb+') as tiff:
+            record['regions'].append(self._hash_and_wipe(tiff, 'label', label_strips, archive, chunk_size))
+            record['regions'].append(self._hash_and_wipe(tiff, 'macro', macro_strips, archive, chunk_size))
+        record['finished'] = utc_timestamp()
+        BYTES_WIPED.inc(sum(region['size'] for region in record['regions']))
+
+        if audit_log is not None:
+            audit_log.append(record)
+        return record
+
+    def _hash_and_wipe(self, tiff, region, strips, archive, chunk_size):
+        # one digest over all strips of the image, in strip order
+        digest = hashlib.sha256()
+        read_strips = []
+        for offset, byte_count in strips:
+            position = offset
+            end = offset + byte_count
+            tiff.seek(position)
+            while position < end:
+                chunk = tiff.read(min(chunk_size, end - position))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if archive is not None:
+                    archive.write(str(self.file_path), region, position, chunk)
+                position += len(chunk)
+            read_strips.append((offset, position - offset))
+
+        # the encrypted copy must be on disk before the original bytes are destroyed
+        if archive is not None:
+            archive.flush()
+        for offset, byte_count in read_strips:
+            tiff.seek(offset)
+            position = offset
+            while position < offset + byte_count:
+                length = min(chunk_size, offset + byte_count - position)
+                tiff.write(b'\0' * length)
+                position += length
+        size = sum(byte_count for _, byte_count in read_strips)
+
+        region_record = {
+            'region': region,
+            'offset': strips[0][0],
+            'size': size,
+            'sha256': digest.hexdigest(),
+            'wiped': utc_timestamp()
+        }
+        if len(strips) > 1:
+            region_record['strips'] = [list(strip) for strip in strips]
+        return region_record
 
 
     def get_label(self):
         """Returns the label image as a Pillow Image object
         """
+        if len(self._label['strips']) > 1:
+            # LabelSaver writes a single strip
+            img, _ = self.get_raw_image('label')
+            return Image.open(img)
         ls = LabelSaver()
         img = ls.label(self.label_data, self.label_info)
         return img
 
+    def get_raw_image(self, image_type='label'):
+        """Returns the compressed label or macro strip wrapped in a minimal standalone
+        container. The image data is copied as is - nothing is decoded or re-encoded.
+
+        Args:
+            image_type (str, optional): 'label' or 'macro'. Defaults to 'label'.
+
+        Raises:
+            ValueError: If the image type is not 'label' or 'macro' or was not found in the slide
+
+        Returns:
+            tuple: (BytesIO, str) the container and its file extension ('.jpg' or '.tif')
+        """
+        image_info = self._image_info(image_type)
+        ifd_info = image_info[f'{image_type} ifd info']
+        jpeg_tables = None
+        if 347 in ifd_info:
+            jpeg_tables = self._get_tag_data(ifd_info[347])
+
+        raw_saver = RawImageSaver()
+        img = raw_saver.save(self._get_strips(image_info), ifd_info, jpeg_tables)
+        return img, raw_saver.extension
+
+    def save_raw_image(self, save_path, image_type='label'):
+        """Saves the compressed label or macro strip without decoding it. The
+        suffix of save_path is replaced with the extension of the container.
+        Must be used before overwriting the label with de_identify_slide
+
+        Args:
+            save_path (str): path of the output file
+            image_type (str, optional): 'label' or 'macro'. Defaults to 'label'.
+
+        Returns:
+            Path: path of the saved file
+        """
+        img, extension = self.get_raw_image(image_type)
+        save_path = Path(save_path).with_suffix(extension)
+        with open(save_path, 'wb') as raw_file:
+            raw_file.write(img.getbuffer())
+        return save_path
+
     def print_IFDs(self, writer=sys.stdout):
         writer.write('=' * 80 + '\n')
         writer.write('=' * 80 + '\n')
@@ -92,9 +252,14 @@ class BigTiffFile():
     def _read_header(self, bigtiff):
         endian = bigtiff.read(2).decode('UTF-8')
         version = struct.unpack('<H', bigtiff.read(struct.calcsize('H')))[0]
+        if endian == 'II' and version == CLASSIC_TIFF['version']:
+            self.endian = endian
+            self.layout = CLASSIC_TIFF
+            return struct.unpack('<L', bigtiff.read(struct.calcsize('<L')))[0]
+
         offset_size, reserved = struct.unpack('<HH', bigtiff.read(struct.calcsize('HH')))
         initial_offset = struct.unpack('<Q', bigtiff.read(struct.calcsize('Q')))[0]
-        if endian != 'II' or version != 43 or offset_size != 8 or reserved != 0:
+        if endian != 'II' or version != BIG_TIFF['version'] or offset_size != 8 or reserved != 0:
             _error = 'File Not Supported: {}\nEndian: {}\nVersion: {}\nOffset_size: {}\nReserved: {}'.format(
                 self.file_path,
                 endian,
@@ -103,31 +268,37 @@ class BigTiffFile():
                 reserved
                 )
             raise Exception(_error)    
+        self.endian = endian
+        self.bigtiff = True
+        self.layout = BIG_TIFF
         return initial_offset
         
     def _read_IFDs(self, bigtiff, directory_offset):
         self.directory_count += 1
         bigtiff.seek(directory_offset)
         IFD_info = {}
-        num_of_entries = struct.unpack('<Q', bigtiff.read(8))[0]
+        count_format = self.layout['count']
+        entry_format = self.layout['entry']
+        offset_format = self.layout['offset']
+        num_of_entries = struct.unpack(count_format, bigtiff.read(struct.calcsize(count_format)))[0]
         for _ in range(num_of_entries):
             tag_offset = bigtiff.tell()
-            IFD_tag, IFD_type, IFD_count = struct.unpack('<HHQ', bigtiff.read(struct.calcsize('<HHQ')))
+            IFD_tag, IFD_type, IFD_count = struct.unpack(entry_format, bigtiff.read(struct.calcsize(entry_format)))
             pre_data_offset = bigtiff.tell()
-            data_offset = struct.unpack('<Q', bigtiff.read(struct.calcsize('<Q')))[0]
+            field = bigtiff.read(struct.calcsize(offset_format))
+            data_offset = struct.unpack(offset_format, field)[0]
 
-            IFD_info[IFD_tag] = {
+            IFD_info[IFD_tag] = LazyTagInfo({
                 'pre_tag_offset': tag_offset,
                 'ifd_type': IFD_type,
                 'ifd_count': IFD_count,
                 'pre_data_offset': pre_data_offset,
-                'data_offset': data_offset,
-                'value': self._ifd_value(IFD_tag, IFD_type, IFD_count, pre_data_offset, data_offset, bigtiff)
-            }
+                'data_offset': data_offset
+            }, loader=partial(self._load_tag_value, IFD_tag, field))
         # position before the next IFD offset. This can be used to change
         # the location of the next IFD
         offset_before_next_ifd_offset = bigtiff.tell()
-        next_ifd_offset = struct.unpack('<Q', bigtiff.read(8))[0]
+        next_ifd_offset = struct.unpack(offset_format, bigtiff.read(struct.calcsize(offset_format)))[0]
         self.tiff_info[self.directory_count] = IFD_info
         self.directory_offsets[self.directory_count] = directory_offset
         self.next_dir_offsets[self.directory_count] = {
@@ -138,25 +309,57 @@ class BigTiffFile():
         return next_ifd_offset
     
 
-    def _ifd_value(self, ifd_tag, ifd_type, ifd_count, pre_data_offset, data_offset, bigtiff):
-        fmt = '<' + str(ifd_count) + FORMAT_CHARACTERS[ifd_type]
+    def _load_tag_value(self, ifd_tag, field, ifd_data):
+        # values that fit in the IFD entry are decoded from the entry bytes read with the IFD
+        fmt = '<' + str(ifd_data['ifd_count']) + FORMAT_CHARACTERS[ifd_data['ifd_type']]
         length = struct.calcsize(fmt)
-        if length <= struct.calcsize('Q'):
-            start = bigtiff.tell()
-            bigtiff.seek(pre_data_offset)
-            value = struct.unpack(fmt, bigtiff.read(struct.calcsize(fmt)))
-            bigtiff.seek(start)
-        elif ifd_tag in [270, 258]:
-            current_position = bigtiff.tell()
-            bigtiff.seek(data_offset)
-            value = struct.unpack(fmt, bigtiff.read(struct.calcsize(fmt)))
-            if TYPE_DICT.get(ifd_type) == 'ASCII':
-                value = b''.join(value)
-            bigtiff.seek(current_position)
-        else:
+        if length <= len(field):
+            return struct.unpack(fmt, field[:length])
+        if ifd_tag not in [270, 258]:
             return 'Too long to display'
+
+        value = struct.unpack(fmt, self._read_bytes(ifd_data['data_offset'], length))
+        if TYPE_DICT.get(ifd_data['ifd_type']) == 'ASCII':
+            value = b''.join(value)
         return value
 
+    def _read_bytes(self, offset, length):
+        # reuses the stream while the IFDs are being read or the file is a BytesIO
+        if self._stream is not None and not self._stream.closed:
+            position = self._stream.tell()
+            self._stream.seek(offset)
+            data = self._stream.read(length)
+            self._stream.seek(position)
+            return data
+        with open(self.file_path, 'rb') as tiff:
+            tiff.seek(offset)
+            return tiff.read(length)
+
+    def image_description(self, directory: int=1):
+        """Parses the Aperio ImageDescription (tag 270) of a directory once and caches it.
+        Directory 1 describes the scan (dimensions, MPP, AppMag, ScanScope ID, date, ...).
+
+        Args:
+            directory (int, optional): directory number. Defaults to 1.
+
+        Returns:
+            dict | None: see utils.aperio.parse_image_description, None if the directory has no description
+        """
+        if directory not in self._descriptions:
+            description_info = self.tiff_info[directory].get(270)
+            if description_info is None:
+                self._descriptions[directory] = None
+            else:
+                description = description_info['value']
+                if isinstance(description, tuple):
+                    description = b''.join(description)
+                self._descriptions[directory] = parse_image_description(description)
+        return self._descriptions[directory]
+
+    def _image_type(self, directory):
+        description = self.image_description(directory)
+        return description['image type'] if description is not None else None
+
     def _get_label_and_macro_info(self):
         #the label is the second to last directory, compressed with LZW, and may (depending
         #on Leica software version) have label in tag 270
@@ -164,33 +367,36 @@ class BigTiffFile():
         proprosed_macro_directory = len(self.tiff_info.items())
 
         label_compression = self.tiff_info[proposed_label_directory][259]['data_offset']
-        try:
-            image_description = self.tiff_info[proposed_label_directory][270]['value']
-        except Exception:
-            image_description = None
-
-        if COMPRESSION.get(label_compression) == 'LZW' or b'label' in image_description or b'Label' in image_description:
+        if COMPRESSION.get(label_compression) == 'LZW' or self._image_type(proposed_label_directory) == 'label':
             self._label = {
                 'label directory': proposed_label_directory,
                 'label ifd info': self.tiff_info[proposed_label_directory],
-                'strip offset': self.tiff_info[proposed_label_directory][273]['data_offset'],
-                'strip byte counts': self.tiff_info[proposed_label_directory][279]['data_offset']
+                'strips': self._read_strips(self.tiff_info[proposed_label_directory])
             }
 
         macro_compression = self.tiff_info[proprosed_macro_directory][259]['data_offset']
-        try:
-            image_description = self.tiff_info[proprosed_macro_directory][270]['value']
-        except Exception:
-            image_description = None
-
-        if COMPRESSION.get(macro_compression) in ['JPEG', 'JPEG 7'] or b'macro' in image_description or b'Macro' in image_description:
+        if COMPRESSION.get(macro_compression) in ['JPEG', 'JPEG 7'] or self._image_type(proprosed_macro_directory) == 'macro':
             self._macro = {
                 'macro directory': proprosed_macro_directory,
                 'macro ifd info': self.tiff_info[proprosed_macro_directory],
-                'strip offset': self.tiff_info[proprosed_macro_directory][273]['data_offset'],
-                'strip byte counts': self.tiff_info[proprosed_macro_directory][279]['data_offset']
+                'strips': self._read_strips(self.tiff_info[proprosed_macro_directory])
             }
 
+    def _read_strips(self, ifd_info):
+        # (offset, byte count) of every strip. Older classic TIFF slides store the label in
+        # many strips, then 273 and 279 point to arrays instead of holding the values
+        if 273 not in ifd_info or 279 not in ifd_info:
+            raise ValueError(f'{self.file_path}: the label or macro has no strips')
+        if ifd_info[273]['ifd_count'] == 1 and ifd_info[279]['ifd_count'] == 1:
+            return [(ifd_info[273]['data_offset'], ifd_info[279]['data_offset'])]
+
+        offsets = self._read_tag_values(self._stream, ifd_info[273])
+        byte_counts = self._read_tag_values(self._stream, ifd_info[279])
+        if not offsets or len(offsets) != len(byte_counts):
+            _error = f'{self.file_path}: {len(offsets)} strip offsets but {len(byte_counts)} strip byte counts'
+            raise ValueError(_error)
+        return list(zip(offsets, byte_counts))
+
     @property
     def label_IFD_offset_adjustment(self):
         """The offset of the label directory
@@ -200,27 +406,106 @@ class BigTiffFile():
         """
         offset = self.directory_offsets[self._label['label directory']]
         return offset
+
+    def directory_extents(self):
+        """Byte range referenced by each directory: the IFD itself, tag data stored outside
+        the IFD and the strip or tile data. Reads the strip and tile offset arrays.
+
+        Returns:
+            dict: directory number: (first byte, end) where end is one past the last byte
+        """
+        extents = {}
+        offset_size = struct.calcsize(self.layout['offset'])
+        entry_size = struct.calcsize(self.layout['entry']) + offset_size
+        with open(self.file_path, 'rb') as tiff:
+            for directory, ifd_info in self.tiff_info.items():
+                start = self.directory_offsets[directory]
+                # entry count, entries and the next IFD offset
+                end = start + struct.calcsize(self.layout['count']) + len(ifd_info) * entry_size + offset_size
+
+                for ifd_data in ifd_info.values():
+                    length = struct.calcsize('<' + str(ifd_data['ifd_count']) + FORMAT_CHARACTERS[ifd_data['ifd_type']])
+                    if length > offset_size:
+                        start = min(start, ifd_data['data_offset'])
+                        end = max(end, ifd_data['data_offset'] + length)
+
+                for offsets_tag, counts_tag in ((273, 279), (324, 325)):
+                    if offsets_tag not in ifd_info or counts_tag not in ifd_info:
+                        continue
+                    offsets = self._read_tag_values(tiff, ifd_info[offsets_tag])
+                    byte_counts = self._read_tag_values(tiff, ifd_info[counts_tag])
+                    for offset, byte_count in zip(offsets, byte_counts):
+                        if byte_count:
+                            start = min(start, offset)
+                            end = max(end, offset + byte_count)
+                extents[directory] = (start, end)
+        return extents
+
+    def _read_tag_values(self, tiff, ifd_data):
+        fmt = '<' + str(ifd_data['ifd_count']) + FORMAT_CHARACTERS[ifd_data['ifd_type']]
+        length = struct.calcsize(fmt)
+        if length <= struct.calcsize(self.layout['offset']):
+            tiff.seek(ifd_data['pre_data_offset'])
+        else:
+            tiff.seek(ifd_data['data_offset'])
+        return struct.unpack(fmt, tiff.read(length))
     
 
-    def _get_label_data(self):
-        label_strip_offset = self._label['strip offset']
-        label_byte_count = self._label['strip byte counts']
+    def _image_info(self, image_type):
+        if image_type == 'label':
+            image_info = self._label
+        elif image_type == 'macro':
+            image_info = self._macro
+        else:
+            raise ValueError(f'{image_type} must be label or macro')
 
+        if image_info is None:
+            raise ValueError(f'No {image_type} found in {self.file_path}')
+        return image_info
+
+    def _get_strips(self, image_info):
+        strips = []
         with open(self.file_path, 'rb') as tiff:
-            tiff.seek(label_strip_offset)
-            label_data = tiff.read(label_byte_count)
-        return label_data
+            for strip_offset, byte_count in image_info['strips']:
+                tiff.seek(strip_offset)
+                strips.append(tiff.read(byte_count))
+        return strips
+
+    def _get_strip_data(self, image_info):
+        return b''.join(self._get_strips(image_info))
+
+    def _get_tag_data(self, ifd_data):
+        fmt = '<' + str(ifd_data['ifd_count']) + FORMAT_CHARACTERS[ifd_data['ifd_type']]
+        length = struct.calcsize(fmt)
+        if length <= struct.calcsize(self.layout['offset']):
+            offset = ifd_data['pre_data_offset']
+        else:
+            offset = ifd_data['data_offset']
+        return self._read_bytes(offset, length)
+
+    def _get_label_data(self):
+        return self._get_strip_data(self._label)
 
     @property
     def label_data(self):
-        """Label data in bytes. Does not include the IFD. Must be used
-        before overwriting the label with de_identify_slide
+        """Label data in bytes. Does not include the IFD. Labels stored in several
+        strips are concatenated. Must be used before overwriting the label with de_identify_slide
 
         Returns:
             bytes: byte string containing the raw label information
         """
         return self._get_label_data()
 
+    @property
+    def macro_data(self):
+        """Macro data in bytes. Does not include the IFD. Must be used
+        before overwriting the macro with de_identify_slide
+
+        Returns:
+            bytes: byte string containing the raw macro information
+        """
+        return self._get_strip_data(self._macro)
+
     @property
     def label_info(self):
         """Information on the label BigTiff directory. Used in the LabelSaver
@@ -233,7 +518,7 @@ class BigTiffFile():
         return self._label
 
 class SubImage():
-    def __init__(self, file_type, label_params=None) -> None:
+    def __init__(self, file_type, label_params=None, label_cache: LabelCache=None, bigtiff: bool=True) -> None:
         """Creates a label or macro image to write into a whole slide image. Only
         works with Aperio whole slide images
 
@@ -243,11 +528,15 @@ class SubImage():
             label_params (dict, optional): Contains the text for the QR code and any desired
             sub text beneath the QR code. Supports ~ 3 lines of text. More may not fit on 
             the label. Defaults to None.
+            label_cache (LabelCache, optional): cache of encoded images shared across slides. Defaults to None.
+            bigtiff (bool, optional): create a BigTIFF image, False for classic TIFF slides. Defaults to True.
 
         Raises:
             ValueError: If file type is not 'label' or 'macro'
         """
         self.label_params = label_params
+        self.label_cache = label_cache
+        self.bigtiff = bigtiff
 
         if file_type not in ['label', 'macro']:
             raise ValueError(f'{file_type} must be label or macro')
@@ -257,36 +546,65 @@ class SubImage():
         self._label_offset_adjustment = None
     
     def create_image(self):
-        if self.file_type == 'label':
-            img = self._create_label()
+        if self.label_cache is None:
+            return self._encode_image()
+
+        cache_key = self._cache_key()
+        cached = self.label_cache.get(cache_key)
+        if cached is not None:
+            LABEL_CACHE_REQUESTS.inc(result='hit')
+            return io.BytesIO(cached[0])
+        LABEL_CACHE_REQUESTS.inc(result='miss')
+
+        img = self._encode_image()
+        btf = BigTiffFile(img)
+        dimensions = (btf.tiff_info[1][256]['value'][0], btf.tiff_info[1][257]['value'][0])
+        self.label_cache.put(cache_key, img.getvalue(), dimensions)
+        img.seek(0)
+        return img
 
+    def _cache_key(self):
+        params = {
+            'file_type': self.file_type,
+            'version': LABEL_CACHE_VERSION,
+            'compression': BIG_TIFF_LABEL_TEMPLATE[259]['value'],
+            'bigtiff': self.bigtiff,
+        }
+        if self.file_type == 'label':
+            font = self._get_font()
+            params['label_params'] = list(self.label_params) if self.label_params else None
+            params['font'] = (getattr(font, 'path', None), getattr(font, 'size', None))
+            params['dimensions'] = LABEL_DIMENSIONS
         else:
-            img = self._create_macro()
+            params['dimensions'] = MACRO_DIMENSIONS
+        return LabelCache.key(**params)
 
-        img = np.array(img)
+    def _encode_image(self):
+        with PHASE_SECONDS.time(phase='render'):
+            if self.file_type == 'label':
+                img = self._create_label()
 
-        if self.file_type == 'label':
-            btm = BigTiffMaker(img, 'label')
-            img = btm.create_image()
+            else:
+                img = self._create_macro()
 
-        else:
-            btm = BigTiffMaker(img, 'macro')
-            img = btm.create_image()
+            img = np.array(img)
+
+        with PHASE_SECONDS.time(phase='serialize'):
+            if self.file_type == 'label':
+                btm = BigTiffMaker(img, 'label', bigtiff=self.bigtiff)
+                img = btm.create_image()
+
+            else:
+                btm = BigTiffMaker(img, 'macro', bigtiff=self.bigtiff)
+                img = btm.create_image()
         
         return img
     
-    def _create_macro(self, img_dims=(1495, 606)):
+    def _create_macro(self, img_dims=MACRO_DIMENSIONS):
         img = Image.new('RGB', img_dims, 'red')
         return img
         
-    def _create_label(self, img_dims =(609, 567)):
-        """Creates a label image with a QR code and text under the QR code
-
-        Returns:
-            img: label with image
-        """
-        
-
+    def _get_font(self):
         try:
             myFont = ImageFont.truetype('arial.ttf', size=30) # Windows
         except OSError:
@@ -295,6 +613,15 @@ class SubImage():
             except OSError:
                     print('FONT NOT FOUND ERROR')
                     sys.exit()
+        return myFont
+
+    def _create_label(self, img_dims=LABEL_DIMENSIONS):
+        """Creates a label image with a QR code and text under the QR code
+
+        Returns:
+            img: label with image
+        """
+        myFont = self._get_font()
 
         qr_img = None
         if self.label_params: # qr code string
@@ -333,18 +660,25 @@ class SubImage():
         return img
         
 
-    def update_ifd(self, file, offset_adjustment):
+    def update_ifd(self, file, offset_adjustment, next_ifd_offset: int=None):
         """Updates the SVS file IFDs for the label and macro to correct the offsets.
 
         Args:
             file (BytesIO): BytesIO image object
             offset_adjustment (int): offset to adjust the IFD
+            next_ifd_offset (int, optional): offset of the directory after the label. Defaults
+            to the size of the label image past offset_adjustment.
+
+        Raises:
+            ValueError: If an offset of a classic TIFF image does not fit in 4 bytes
 
         Returns:
             BytesIO: Label or macro image file with updated IFDs to be inserted into the SVS file
         """
         tiff_data = BigTiffFile(file)
         dir_offsets = tiff_data.next_dir_offsets
+        offset_format = tiff_data.layout['offset']
+        header_size = tiff_data.layout['header_size']
 
         for tag in tiff_data.tiff_info[1].keys():
             ifd_count = tiff_data.tiff_info[1][tag]['ifd_count']
@@ -353,29 +687,39 @@ class SubImage():
             fmt = '<' + str(ifd_count) + FORMAT_CHARACTERS[ifd_type]
             length = struct.calcsize(fmt)
                 
-            if length > struct.calcsize('<Q') or tag == 273:
+            if length > struct.calcsize(offset_format) or tag == 273:
                 pre_data_offset = tiff_data.tiff_info[1][tag]['pre_data_offset']
                 data_offset = tiff_data.tiff_info[1][tag]['data_offset']
 
-                new_offset = data_offset + offset_adjustment - 16                    
+                new_offset = data_offset + offset_adjustment - header_size
+                self._check_offset(tiff_data, new_offset)
 
-                updated_offset = struct.pack('<Q', new_offset)
+                updated_offset = struct.pack(offset_format, new_offset)
                 file.seek(pre_data_offset)
                 file.write(updated_offset)
 
         # updates the next IFD of the label directory
         if self.file_type == 'label':
             end_of_ifd = dir_offsets[1]['pre_offset_offset']
-            file.seek(0, os.SEEK_END)
-            end_of_file = file.tell()
-            new_next_ifd_offset = end_of_file + offset_adjustment
-            new_next_ifd = struct.pack('<Q', new_next_ifd_offset)
+            if next_ifd_offset is None:
+                file.seek(0, os.SEEK_END)
+                end_of_file = file.tell()
+                new_next_ifd_offset = end_of_file + offset_adjustment
+            else:
+                new_next_ifd_offset = next_ifd_offset
+            self._check_offset(tiff_data, new_next_ifd_offset)
+            new_next_ifd = struct.pack(offset_format, new_next_ifd_offset)
             file.seek(end_of_ifd)
             file.write(new_next_ifd)
             self._label_offset_adjustment = new_next_ifd_offset
         
         return file
 
+    def _check_offset(self, tiff_data: BigTiffFile, offset: int):
+        if not tiff_data.bigtiff and offset > CLASSIC_TIFF_MAX_OFFSET:
+            _error = f'The {self.file_type} offset {offset} exceeds the 4 GB limit of classic TIFF'
+            raise ValueError(_error)
+
     @property
     def offset_adjustment(self):
         return self._label_offset_adjustment
@@ -383,7 +727,9 @@ class SubImage():
 
 class LabelSwitcher():
     def __init__(self, slide_path, remove_original_label_and_macro: bool=True, \
-        qrcode:str=None, text_line1:str=None, text_line2:str=None, text_line3:str=None, text_line4:str=None) -> None:
+        qrcode:str=None, text_line1:str=None, text_line2:str=None, text_line3:str=None, text_line4:str=None, \
+        audit_log: AuditLog=None, archive: EncryptedArchiveSink=None, label_cache: LabelCache=None, \
+        compact: bool=False) -> None:
         """WARNING: THIS UTILITY PERFORMS IN PLACE OPERATIONS ON SVS FILES. THE FILES ARE NOT COPIED!
         PLEASE MAKE COPIES PRIOR TO USE.
 
@@ -402,140 +748,913 @@ class LabelSwitcher():
             text_line1 (str, optional): line of text that appears on label. Defaults to None.
             text_line2 (str, optional): line of text that appears on label. Defaults to None.
             text_line3 (str, optional): line of text that appears on label. Defaults to None.
+            audit_log (AuditLog, optional): appends a record with the digests of the wiped label and macro. Defaults to None.
+            archive (EncryptedArchiveSink, optional): keeps an encrypted copy of the wiped bytes. Defaults to None.
+            label_cache (LabelCache, optional): reuses encoded labels across slides with the same text. Defaults to None.
+            compact (bool, optional): place the new label and macro directly after the pyramid data,
+            reusing the space of the original label and macro, and truncate the file after the new
+            macro. The bytes saved are stored in bytes_saved. Defaults to False.
         """
 
         self.slide_path = slide_path
+        self.compact = compact
+        self.bytes_saved = None
+        self._previous_next_ifd_position = None
+        self._layout = None
+        self.label_cache = label_cache
+        self.audit_log = audit_log
+        self.archive = archive
+        self.audit_record = None
         label_params=[qrcode, text_line1, text_line2, text_line3, text_line4]
-        self._slide_offset_adjustment = self._get_slide_offset(remove_original_label_and_macro)
+        slide = BigTiffFile(self.slide_path)
+        self._slide_offset_adjustment = self._get_slide_offset(slide)
         self._next_ifd_offset_adjustment, self._label_img = self._get_label_img(label_params)
         self._macro_img = self._get_macro_img()
+        # the slide is only changed once the new tail is known to fit
+        self._check_classic_tiff_size()
+        if remove_original_label_and_macro:
+            self.audit_record = slide.de_identify_slide(audit_log=self.audit_log, archive=self.archive)
     
     def switch_labels(self):
-        with open(self.slide_path, 'rb+') as slide:
+        with PHASE_SECONDS.time(phase='write'), open(self.slide_path, 'rb+') as slide:
+            original_size = slide.seek(0, os.SEEK_END)
             
             slide.seek(self._slide_offset_adjustment)
 
-            self._label_img.seek(16)
+            self._label_img.seek(self._layout['header_size'])
             label_data = self._label_img.read()
             slide.write(label_data)
 
-            self._macro_img.seek(16)
+            self._macro_img.seek(self._layout['header_size'])
             macro_data = self._macro_img.read()
             slide.seek(self._next_ifd_offset_adjustment)
             slide.write(macro_data)
 
-    def _get_slide_offset(self, remove_label_and_macro):
-        slide = BigTiffFile(self.slide_path)
-        if remove_label_and_macro:
-            slide.de_identify_slide()
+            if self.compact:
+                # the directory before the label points to the new label IFD
+                slide.seek(self._previous_next_ifd_position)
+                slide.write(struct.pack(self._layout['offset'], self._slide_offset_adjustment))
+                slide.truncate(self._next_ifd_offset_adjustment + len(macro_data))
+                self.bytes_saved = original_size - (self._next_ifd_offset_adjustment + len(macro_data))
+                # counters only go up, growth is counted separately
+                BYTES_RECLAIMED.inc(max(self.bytes_saved, 0))
+                BYTES_GROWN.inc(max(-self.bytes_saved, 0))
+        BYTES_WRITTEN.inc(len(label_data) + len(macro_data))
+
+    def _get_slide_offset(self, slide: BigTiffFile):
+        self._layout = slide.layout
+        if self.compact:
+            return self._plan_compact_tail(slide)
         return slide.label_IFD_offset_adjustment
 
+    def _plan_compact_tail(self, slide: BigTiffFile):
+        # The new tail is label IFD, label strip, macro IFD, macro strip. It starts where the
+        # original label and macro structures start, unless data of another directory lies
+        # beyond that point, in which case it starts after that data
+        label_directory = slide.label_info['label directory']
+        macro_directory = slide._macro['macro directory']
+        tail_directories = (label_directory, macro_directory)
+
+        extents = slide.directory_extents()
+        tail_start = min(extents[directory][0] for directory in tail_directories)
+        other_end = max(end for directory, (_, end) in extents.items() if directory not in tail_directories)
+
+        self._previous_next_ifd_position = slide.next_dir_offsets[label_directory - 1]['pre_offset_offset']
+        tail_start = max(tail_start, other_end)
+        return tail_start + tail_start % 2
+
     def _get_label_img(self, label_params):
-        img_creator = SubImage('label', label_params)
+        img_creator = SubImage('label', label_params, label_cache=self.label_cache, bigtiff=self._layout is BIG_TIFF)
         label_image = img_creator.create_image()
-        label_image = img_creator.update_ifd(label_image, self._slide_offset_adjustment)
+        next_ifd_offset = None
+        if self.compact:
+            label_size = len(label_image.getbuffer()) - self._layout['header_size']
+            next_ifd_offset = self._slide_offset_adjustment + label_size + label_size % 2
+        label_image = img_creator.update_ifd(label_image, self._slide_offset_adjustment, next_ifd_offset)
 
         next_ifd_offset = img_creator.offset_adjustment
         return next_ifd_offset, label_image
     
     def _get_macro_img(self):
-        img_creator = SubImage('macro')
+        img_creator = SubImage('macro', label_cache=self.label_cache, bigtiff=self._layout is BIG_TIFF)
         macro_image = img_creator.create_image()
         macro_image = img_creator.update_ifd(macro_image, self._next_ifd_offset_adjustment)
         return macro_image
+
+    def _check_classic_tiff_size(self):
+        if self._layout is BIG_TIFF:
+            return
+        macro_size = len(self._macro_img.getbuffer()) - self._layout['header_size']
+        end_of_file = self._next_ifd_offset_adjustment + macro_size
+        if end_of_file > CLASSIC_TIFF_MAX_OFFSET:
+            _error = f'{self.slide_path}: the new label and macro would end at {end_of_file}, past the 4 GB limit of classic TIFF'
+            raise ValueError(_error)
     
 
-def switch_labels_from_file(file_path: str, col_with_slide_names: str, slide_dir: str=None):
-    """THIS IS A DESTRUCTIVE PROCESS - MAKE COPIES FIRST! Deletes the original label and macro image 
-    on a slide and replaces the label with a custom label containing a QR code 
-    and up to 3 lines of text. The CSV file must include at least a 'File Location' 
-    header. The QR data should be under the header 'QR'. Text should be placed under: 
-    'text1', 'text2', and 'text3'. If the QR or text headers are not present,
-    Placeholder Text will be used for the QR code and blank lines for the text.
+class LabelJob():
+    def __init__(self, slide_path, qrcode: str=None, text_line1: str=None, text_line2: str=None, \
+        text_line3: str=None, text_line4: str=None, remove_original_label_and_macro: bool=True, job_id=None, \
+        switch_label: bool=True, compact: bool=False) -> None:
+        """Specification of one label switch for the batch API. Arguments match LabelSwitcher.
+
+        Args:
+            slide_path (str): full path to SVS file
+            job_id (optional): caller supplied identifier returned with the result, e.g. a LIMS key. Defaults to None.
+            switch_label (bool, optional): False only overwrites the label and macro with de_identify_slide. Defaults to True.
+            compact (bool, optional): reclaim the space of the original label and macro. Defaults to False.
+        """
+        self.slide_path = slide_path
+        self.qrcode = qrcode
+        self.text_lines = [text_line1, text_line2, text_line3, text_line4]
+        self.remove_original_label_and_macro = remove_original_label_and_macro
+        self.job_id = job_id
+        self.switch_label = switch_label
+        self.compact = compact
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Creates a job from a LabelJob, a dict of LabelJob arguments or a slide path
+        """
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, dict):
+            return cls(**spec)
+        return cls(spec)
+
+    def __repr__(self) -> str:
+        return f'LabelJob({self.slide_path!r}, job_id={self.job_id!r})'
+
+
+class LabelJobResult():
+    def __init__(self, job: LabelJob, index: int, error: str=None, audit_record: dict=None, elapsed: float=None,
+        metrics: dict=None, bytes_saved: int=None) -> None:
+        """Outcome of a LabelJob.
+
+        Args:
+            job (LabelJob): the job that was run
+            index (int): position of the job in the input
+            error (str, optional): error message if the switch failed. Defaults to None.
+            audit_record (dict, optional): audit record of the wiped label and macro. Defaults to None.
+            elapsed (float, optional): seconds spent on the job. Defaults to None.
+            metrics (dict, optional): metrics recorded by the worker, see MetricsRegistry.take_delta. Defaults to None.
+            bytes_saved (int, optional): bytes reclaimed by compacting the slide. Defaults to None.
+        """
+        self.job = job
+        self.index = index
+        self.error = error
+        self.audit_record = audit_record
+        self.elapsed = elapsed
+        self.metrics = metrics
+        self.bytes_saved = bytes_saved
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self) -> str:
+        status = 'ok' if self.ok else f'error={self.error!r}'
+        return f'LabelJobResult({self.index}, {self.job.slide_path!r}, {status})'
+
+
+# process whose metric registry was cleared by _init_worker
+_worker_pid = None
+
+
+def _init_worker(ignore_interrupts: bool=False):
+    # forked workers inherit the parent's metric values, which must not be sent back
+    global _worker_pid
+    METRICS.reset()
+    _worker_pid = os.getpid()
+    if ignore_interrupts:
+        _ignore_interrupts()
+
+
+def _run_label_job(job: LabelJob, index: int, audit_log: AuditLog=None, archive: EncryptedArchiveSink=None,
+    label_cache: LabelCache=None, lock: bool=False, parent_pid: int=None):
+    # jobs in the calling process (max_workers=0 or a thread executor) record into the live registry
+    in_worker = parent_pid is not None and os.getpid() != parent_pid
+    if in_worker and _worker_pid != os.getpid():
+        # a process pool supplied by the caller, created without _init_worker
+        _init_worker()
+    start = time.perf_counter()
+    audit_record = None
+    bytes_saved = None
+    error = None
+    outcome = 'ok'
+    try:
+        # the lock covers reading, wiping and writing the slide
+        slide_lock = SlideLock(job.slide_path) if lock else nullcontext()
+        with slide_lock:
+            audit_record, bytes_saved = _switch_job_labels(job, audit_log, archive, label_cache)
+    except SlideLockedError as e:
+        error = str(e)
+        outcome = 'locked'
+    except Exception as e:
+        error = str(e) or repr(e)
+        outcome = 'failed'
+
+    SLIDES.inc(outcome=outcome)
+    # worker processes ship what they recorded back to the parent with the result
+    return LabelJobResult(job, index, error=error, audit_record=audit_record, elapsed=time.perf_counter() - start,
+        metrics=METRICS.take_delta() if in_worker else None, bytes_saved=bytes_saved)
+
+
+def _switch_job_labels(job: LabelJob, audit_log: AuditLog=None, archive: EncryptedArchiveSink=None,
+    label_cache: LabelCache=None):
+    audit_record = None
+    bytes_saved = None
+    if job.switch_label:
+        label_switcher = LabelSwitcher(
+            slide_path=job.slide_path,
+            remove_original_label_and_macro=job.remove_original_label_and_macro,
+            qrcode=job.qrcode,
+            text_line1=job.text_lines[0],
+            text_line2=job.text_lines[1],
+            text_line3=job.text_lines[2],
+            text_line4=job.text_lines[3],
+            audit_log=audit_log,
+            archive=archive,
+            label_cache=label_cache,
+            compact=job.compact)
+        label_switcher.switch_labels()
+        audit_record = label_switcher.audit_record
+        bytes_saved = label_switcher.bytes_saved
+    else:
+        audit_record = BigTiffFile(job.slide_path).de_identify_slide(audit_log=audit_log, archive=archive)
+    return audit_record, bytes_saved
+
+
+def _collect_result(result: LabelJobResult):
+    if result.metrics:
+        METRICS.merge(result.metrics)
+        result.metrics = None
+    return result
+
+
+def iter_switch_labels(jobs, max_workers: int=None, max_in_flight: int=None, ordered: bool=True,
+    audit_log: AuditLog=None, archive: EncryptedArchiveSink=None, label_cache: LabelCache=None, executor=None,
+    lock: bool=False):
+    """THIS IS A DESTRUCTIVE PROCESS - MAKE COPIES FIRST! Switches the labels of a stream of jobs
+    and lazily yields a LabelJobResult for each one. Jobs are pulled from the iterable only when
+    there is room for them, so at most max_in_flight jobs are queued or running at any time and
+    memory use stays constant for arbitrarily long inputs (e.g. a database cursor).
+
+    Failed jobs do not stop the batch; their result carries the error message.
 
     Args:
-        file_path (str): path to csv files containing appropriate headers
+        jobs (iterable): LabelJob objects, dicts of LabelJob arguments or slide paths
+        max_workers (int, optional): worker processes. 0 runs the jobs one by one in the calling
+        process. Defaults to the number of CPUs.
+        max_in_flight (int, optional): maximum number of submitted jobs without a yielded result.
+        Defaults to twice the number of workers.
+        ordered (bool, optional): yield results in input order. If False, results are yielded
+        as jobs complete. Defaults to True.
+        audit_log (AuditLog, optional): batch audit log for the wiped labels and macros. Defaults to None.
+        archive (EncryptedArchiveSink, optional): keeps an encrypted copy of the wiped bytes. Only
+        supported with max_workers=0. Defaults to None.
+        label_cache (LabelCache, optional): reuses encoded labels across slides with the same text. Defaults to None.
+        executor (concurrent.futures.Executor, optional): executor to use instead of creating
+        a process pool. It is not shut down when the batch finishes. Defaults to None.
+        lock (bool, optional): hold a SlideLock on each slide while it is switched. Slides locked by
+        another process fail with a SlideLockedError message. Defaults to False.
+
+    Yields:
+        LabelJobResult: result of each job
     """
+    if max_workers == 0 and executor is None:
+        for index, spec in enumerate(jobs):
+            yield _collect_result(_run_label_job(LabelJob.from_spec(spec), index, audit_log, archive, label_cache, lock))
+        return
+
+    if archive is not None:
+        raise ValueError('An archive can only be written with max_workers=0')
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or max_workers * 2
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker)
+
+    parent_pid = os.getpid()
+    try:
+        if ordered:
+            pending = deque()
+            for index, spec in enumerate(jobs):
+                job = LabelJob.from_spec(spec)
+                pending.append(executor.submit(_run_label_job, job, index, audit_log, None, label_cache, lock, parent_pid))
+                IN_FLIGHT.set(len(pending))
+                if len(pending) >= max_in_flight:
+                    yield _collect_result(pending.popleft().result())
+                    IN_FLIGHT.set(len(pending))
+            while pending:
+                yield _collect_result(pending.popleft().result())
+                IN_FLIGHT.set(len(pending))
+        else:
+            pending = set()
+            for index, spec in enumerate(jobs):
+                job = LabelJob.from_spec(spec)
+                pending.add(executor.submit(_run_label_job, job, index, audit_log, None, label_cache, lock, parent_pid))
+                IN_FLIGHT.set(len(pending))
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    IN_FLIGHT.set(len(pending))
+                    for future in done:
+                        yield _collect_result(future.result())
+            for future in as_completed(pending):
+                yield _collect_result(future.result())
+    finally:
+        IN_FLIGHT.set(0)
+        if own_executor:
+            # also reached when the caller stops iterating early
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _manifest_slide_path(row, col_with_slide_names: str, slide_dir: str=None):
+    slide = Path(row[col_with_slide_names])
+
+    if slide_dir is not None:
+        if slide.suffix != '.svs':
+            slide_name = str(slide.name) + '.svs'
+        else:
+            slide_name = slide.name
+
+        slide_path = Path(slide_dir).joinpath(slide_name)
+    else:
+        slide_path = Path(slide)
+
+    if 'DigitalPathology' in str(slide_path):
+        raise RuntimeError('Cannot remove labels in provided directory!!')
+    return slide_path
+
+
+def _manifest_label_params(row):
+    try:
+        qr_data = row['QR']
+    except KeyError:
+        qr_data = None
+    text_dict = {}
+    expected_text_headers = ['line1', 'line2', 'line3', 'line4']
+    for text_head in expected_text_headers:
+        try:
+            text1 = row[text_head]
+            if len(text1) >= 60:
+                print(f'Warning: "{text1}" may not fit on label - Recommended string length is 60 - current string is {len(text1)}\n')
+            text_dict[text_head] = text1
+            
+        except KeyError:
+            text_dict[text_head] = None
+
+    return {
+        'qrcode': qr_data,
+        'text_line1': text_dict.get('line1'),
+        'text_line2': text_dict.get('line2'),
+        'text_line3': text_dict.get('line3'),
+        'text_line4': text_dict.get('line4')
+    }
+
+
+def _read_manifest(file_path: str):
     if Path(file_path).suffix == '.xlsx':
         df = pd.read_excel(file_path)
     elif Path(file_path).suffix =='.csv':
         df = pd.read_csv(file_path)
     else:
         raise Exception('Only accepts csv and xlsx files')
+    return df
 
-    for index, row in df.iterrows():
-        slide = Path(row[col_with_slide_names])
 
-        if slide_dir is not None:
-            if slide.suffix != '.svs':
-                slide_name = str(slide.name) + '.svs'
-            else:
-                slide_name = slide.name
+def parse_shard(spec: str):
+    """Parses a shard specification like '2/4' (the second of four shards).
 
-            slide_path = Path(slide_dir).joinpath(slide_name)
-        else:
-            slide_path = Path(slide)
+    Returns:
+        tuple: (shard number starting at 1, number of shards)
+    """
+    try:
+        shard, shard_count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f'Shard must look like "2/4", got "{spec}"')
+    if shard_count < 1 or not 1 <= shard <= shard_count:
+        raise ValueError(f'Shard {shard} is not between 1 and {shard_count}')
+    return shard, shard_count
 
-        if 'DigitalPathology' in str(slide_path):
-            raise RuntimeError('Cannot remove labels in provided directory!!')
-        
-        try:
-            qr_data = row['QR']
-        except KeyError:
-            qr_data = None
-        text_dict = {}
-        expected_text_headers = ['line1', 'line2', 'line3', 'line4']
-        for text_head in expected_text_headers:
-            try:
-                text1 = row[text_head]
-                if len(text1) >= 60:
-                    print(f'Warning: "{text1}" may not fit on label - Recommended string length is 60 - current string is {len(text1)}\n')
-                text_dict[text_head] = text1
-                
-            except KeyError:
-                text_dict[text_head] = None
+
+def _in_shard(slide_path, shard):
+    # hashes the slide name so every node agrees on the split, whatever the mount point
+    shard_number, shard_count = shard
+    digest = hashlib.sha256(Path(slide_path).name.encode('UTF-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count == shard_number - 1
+
+
+def _jobs_from_manifest(df: pd.DataFrame, col_with_slide_names: str, slide_dir: str=None, compact: bool=False,
+    shard=None):
+    for index, row in df.iterrows():
+        slide_path = _manifest_slide_path(row, col_with_slide_names, slide_dir)
+        if shard is not None and not _in_shard(slide_path, shard):
+            continue
+        label_params = _manifest_label_params(row)
         
         if int(Path(slide_path).stem[:5]) < 563:
             continue
 
+        yield LabelJob(slide_path=slide_path, job_id=index, compact=compact, **label_params)
+
+
+def _compaction_message(bytes_saved: int):
+    if bytes_saved >= 0:
+        return f'Compaction saved {bytes_saved} bytes'
+    return f'Compaction did not save space - the new labels and macros added {-bytes_saved} bytes'
+
+
+def switch_labels_from_file(file_path: str, col_with_slide_names: str, slide_dir: str=None,
+    audit_log: AuditLog=None, archive: EncryptedArchiveSink=None, label_cache: LabelCache=None,
+    max_workers: int=0, compact: bool=False, shard=None, lock: bool=False, locality: bool=False):
+    """THIS IS A DESTRUCTIVE PROCESS - MAKE COPIES FIRST! Deletes the original label and macro image 
+    on a slide and replaces the label with a custom label containing a QR code 
+    and up to 3 lines of text. The CSV file must include at least a 'File Location' 
+    header. The QR data should be under the header 'QR'. Text should be placed under: 
+    'text1', 'text2', and 'text3'. If the QR or text headers are not present,
+    Placeholder Text will be used for the QR code and blank lines for the text.
+
+    Args:
+        file_path (str): path to csv files containing appropriate headers
+        audit_log (AuditLog, optional): batch audit log for the wiped labels and macros. Defaults to None.
+        archive (EncryptedArchiveSink, optional): keeps an encrypted copy of the wiped bytes. Defaults to None.
+        label_cache (LabelCache, optional): reuses encoded labels across slides with the same text. Defaults to None.
+        max_workers (int, optional): worker processes, see iter_switch_labels. Defaults to 0 (one slide at a time).
+        compact (bool, optional): reclaim the space of the original labels and macros. Defaults to False.
+        shard (tuple, optional): (shard number, number of shards) from parse_shard. Only the slides
+        of this shard are switched, so several nodes can split one manifest. Defaults to None.
+        lock (bool, optional): hold a SlideLock on each slide while it is switched. Defaults to False.
+        locality (bool, optional): switch the slides grouped by device and directory and in order of
+        their position on disk (see utils.ordering) to reduce seeking on spinning disks. Results are
+        still returned in manifest order. Defaults to False.
+
+    Returns:
+        list: LabelJobResult for each slide in manifest order
+    """
+    df = _read_manifest(file_path)
+    jobs = _jobs_from_manifest(df, col_with_slide_names, slide_dir, compact, shard)
+    order = None
+    if locality:
+        jobs = list(jobs)
+        order = locality_order([job.slide_path for job in jobs])
+        jobs = [jobs[index] for index in order]
+
+    results = []
+    for result in iter_switch_labels(jobs, max_workers=max_workers, audit_log=audit_log,
+        archive=archive, label_cache=label_cache, lock=lock):
+        if not result.ok:
+            print('*' * 50, '\n', result.error, '\n', '*' * 50)
+        results.append(result)
+
+    if order is not None:
+        # back to manifest order
+        for result in results:
+            result.index = order[result.index]
+        results.sort(key=lambda result: result.index)
+
+    if compact:
+        bytes_saved = sum(result.bytes_saved for result in results if result.bytes_saved is not None)
+        print(_compaction_message(bytes_saved))
+    return results
+
+
+def _new_label_and_macro(label_params, label_offset: int, layout: dict, label_cache: LabelCache=None):
+    # the label and macro LabelSwitcher writes at label_offset, as (offset, bytes) without the TIFF header
+    bigtiff = layout is BIG_TIFF
+    label_creator = SubImage('label', label_params, label_cache=label_cache, bigtiff=bigtiff)
+    label_image = label_creator.update_ifd(label_creator.create_image(), label_offset)
+    macro_offset = label_creator.offset_adjustment
+    macro_creator = SubImage('macro', label_cache=label_cache, bigtiff=bigtiff)
+    macro_image = macro_creator.update_ifd(macro_creator.create_image(), macro_offset)
+
+    header_size = layout['header_size']
+    return [
+        (label_offset, label_image.getvalue()[header_size:]),
+        (macro_offset, macro_image.getvalue()[header_size:])
+    ]
+
+
+def stream_de_identify(source, sink, label_params: list=None, label_cache: LabelCache=None, window: int=STREAM_WINDOW):
+    """De-identifies a slide read sequentially from source (e.g. stdin of a transfer pipeline)
+    and writes it to sink without landing it on disk. The pyramid is passed through untouched
+    and the label and macro are zeroed, giving the same bytes as de_identify_slide in place.
+    With label_params the label and macro are also replaced like LabelSwitcher does.
+
+    Memory use is bounded by the window plus the label and macro, see StreamingDeidentifier.
+    If the stream fails part of the output may already be written and must be discarded.
+
+    Args:
+        source: binary file-like object to read the slide from
+        sink: binary file-like object to write the de-identified slide to
+        label_params (list, optional): [qrcode, text_line1, text_line2, text_line3, text_line4] of a
+        new label. Defaults to None (only zero the label and macro).
+        label_cache (LabelCache, optional): reuses encoded labels across slides with the same text. Defaults to None.
+        window (int, optional): bytes held back until the IFDs referencing them are read. Defaults to 32 MiB.
+
+    Returns:
+        dict: summary from StreamingDeidentifier.run
+    """
+    replacement = None
+    if label_params is not None:
+        replacement = partial(_new_label_and_macro, label_params, label_cache=label_cache)
+    deidentifier = StreamingDeidentifier(window=window, replacement=replacement)
+    with PHASE_SECONDS.time(phase='stream'):
+        summary = deidentifier.run(source, sink)
+    BYTES_WIPED.inc(summary['label']['size'] + summary['macro']['size'])
+    return summary
+
+
+class ManifestLookup():
+    def __init__(self, file_path: str, col_with_slide_names: str='File Location') -> None:
+        """Label text lookup for watch_folder backed by a csv or xlsx manifest with the same
+        headers as switch_labels_from_file. Slides are matched on the file name without extension.
+
+        Args:
+            file_path (str): path to csv or xlsx file
+            col_with_slide_names (str, optional): header of the slide name column. Defaults to 'File Location'.
+        """
+        df = _read_manifest(file_path)
+        self._label_params = {}
+        for _, row in df.iterrows():
+            self._label_params[Path(str(row[col_with_slide_names])).stem] = _manifest_label_params(row)
+
+    def __call__(self, slide_path):
+        return self._label_params.get(Path(slide_path).stem)
+
+
+def _load_lookup(spec: str):
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError(f'{spec} must be in the form module:function')
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def _ignore_interrupts():
+    # Ctrl+C reaches the whole process group. Workers must finish the slide they are
+    # rewriting; the parent process drains them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _slide_is_complete(slide_path):
+    try:
+        slide = BigTiffFile(slide_path)
+    except Exception:
+        return False
+    if slide._label is None or slide._macro is None:
+        return False
+    file_size = os.path.getsize(slide_path)
+    for image_info in (slide._label, slide._macro):
+        if any(strip_offset + byte_count > file_size for strip_offset, byte_count in image_info['strips']):
+            return False
+    return True
+
+
+def _finish_watch_job(watcher: FolderWatcher, future, job: LabelJob, output_dir, on_result):
+    result = _collect_result(future.result())
+    if result.ok and output_dir is not None:
+        destination = Path(output_dir).joinpath(Path(job.slide_path).name)
         try:
+            # a slide with a reused name must not replace one that was already de-identified
+            if destination.exists():
+                raise FileExistsError(f'{destination} already exists')
+            shutil.move(str(job.slide_path), str(destination))
+        except OSError as e:
+            result.error = f'de-identified but not moved to {output_dir}: {e}'
+    watcher.mark_processed(job.slide_path)
+
+    if result.ok:
+        print(f'{job.slide_path}: done in {result.elapsed:.2f} s')
+    else:
+        print('*' * 50, '\n', f'{job.slide_path}: {result.error}', '\n', '*' * 50)
+    if on_result is not None:
+        on_result(result)
 
-            label_switcher = LabelSwitcher(
-                slide_path=slide_path,
-                remove_original_label_and_macro=True,
-                qrcode=qr_data,
-                text_line1=text_dict.get('line1'),
-                text_line2=text_dict.get('line2'),
-                text_line3=text_dict.get('line3'),
-                text_line4=text_dict.get('line4'))
 
-            label_switcher.switch_labels()
-        except Exception as e:
-            print('*' * 50, '\n', e, '\n', '*' * 50)
+def watch_folder(directories, lookup=None, output_dir: str=None, max_workers: int=None, poll_interval: float=5.0,
+    settle_seconds: float=10.0, use_inotify: bool=True, audit_log: AuditLog=None, label_cache: LabelCache=None,
+    stop_event: threading.Event=None, on_result=None, metrics_file: str=None, lock: bool=False):
+    """THIS IS A DESTRUCTIVE PROCESS - MAKE COPIES FIRST! Watches scanner output directories and
+    de-identifies each new SVS file as soon as it is completely written: its size has settled and
+    BigTiffFile can read the full directory chain including the label and macro strips.
+
+    The label text is resolved with lookup(slide_path), which returns a dict of LabelSwitcher
+    label arguments (qrcode, text_line1, ...). If there is no lookup or it returns None, the label
+    and macro are only overwritten with de_identify_slide.
+
+    Runs until stop_event is set. Slides that are already being processed are finished before
+    returning; slides that were found but not started are picked up on the next run.
+
+    Args:
+        directories (list): directories to watch
+        lookup (callable, optional): maps a slide path to label arguments. Defaults to None.
+        output_dir (str, optional): processed slides are moved here. Existing files are never
+        replaced; a slide that cannot be moved is reported as failed and stays in place. Without
+        it, processed slides stay in place and are only skipped while the daemon keeps running.
+        Defaults to None.
+        max_workers (int, optional): worker processes. Defaults to the number of CPUs.
+        poll_interval (float, optional): seconds between checks of the directories. Defaults to 5.0.
+        settle_seconds (float, optional): seconds a file must be unchanged before it is read. Defaults to 10.0.
+        use_inotify (bool, optional): use inotify on Linux instead of polling. Defaults to True.
+        audit_log (AuditLog, optional): batch audit log for the wiped labels and macros. Defaults to None.
+        label_cache (LabelCache, optional): reuses encoded labels across slides with the same text. Defaults to None.
+        stop_event (threading.Event, optional): set to stop watching. Defaults to None.
+        on_result (callable, optional): called with the LabelJobResult of each slide. Defaults to None.
+        metrics_file (str, optional): metrics are written to this file for the node_exporter textfile
+        collector after every check of the directories. Defaults to None.
+        lock (bool, optional): hold a SlideLock on each slide while it is processed. Defaults to False.
+    """
+    stop_event = stop_event or threading.Event()
+    max_workers = max_workers or os.cpu_count() or 1
+    queued = deque()
+    in_flight = {}
+    index = 0
+
+    watcher = FolderWatcher(directories, poll_interval=poll_interval, settle_seconds=settle_seconds,
+        is_complete=_slide_is_complete, use_inotify=use_inotify)
+    with watcher, ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+        initargs=(True,)) as executor:
+        print(f'Watching {", ".join(str(directory) for directory in directories)} ({watcher.mode})')
+        while not stop_event.is_set():
+            if len(in_flight) < max_workers:
+                queued.extend(watcher.poll())
+            else:
+                wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+
+            while queued and len(in_flight) < max_workers and not stop_event.is_set():
+                slide_path = queued.popleft()
+                try:
+                    label_params = lookup(slide_path) if lookup is not None else None
+                except Exception as e:
+                    print('*' * 50, '\n', f'{slide_path}: label lookup failed: {e}', '\n', '*' * 50)
+                    watcher.mark_processed(slide_path)
+                    continue
+                if label_params is None:
+                    job = LabelJob(slide_path, switch_label=False)
+                else:
+                    job = LabelJob(slide_path, **label_params)
+                in_flight[executor.submit(_run_label_job, job, index, audit_log, None, label_cache, lock, os.getpid())] = job
+                index += 1
+
+            for future in [future for future in in_flight if future.done()]:
+                _finish_watch_job(watcher, future, in_flight.pop(future), output_dir, on_result)
+
+            QUEUE_DEPTH.set(len(queued))
+            IN_FLIGHT.set(len(in_flight))
+            if metrics_file is not None:
+                METRICS.write_textfile(metrics_file)
+
+        # graceful drain
+        for future in as_completed(list(in_flight)):
+            _finish_watch_job(watcher, future, in_flight.pop(future), output_dir, on_result)
+        IN_FLIGHT.set(0)
+        if metrics_file is not None:
+            METRICS.write_textfile(metrics_file)
 
 
 def label_saver(args: argparse.Namespace):
     path = args.path
     output_directory = args.outdir
+    if output_directory is None and args.pack is None:
+        raise ValueError('Either an output directory or a pack is required')
+    if args.macro and not args.raw:
+        raise ValueError('-macro requires -raw')
 
     if Path(path).is_dir():
         slides = Path(path).glob('*.svs')
     elif Path(path).is_file() and Path(path).suffix == '.svs':
-        slides = [path]
+        slides = [Path(path)]
     else:
         _error = f'{path} is not a valid file or directory'
         raise ValueError(_error)
+
+    if args.pack is not None:
+        pack_labels(slides, args.pack, raw=args.raw, include_macro=args.macro)
+        return
         
     for slide in slides:
         save_name = Path(output_directory).joinpath(slide.stem + '.jpg')
         try:
             label = BigTiffFile(slide)
-            img = label.get_label()
-            img.save(save_name)
+            if args.raw:
+                label.save_raw_image(save_name, 'label')
+                if args.macro:
+                    # save_raw_image replaces the suffix, so the name must end in one. Without it,
+                    # with_suffix would treat '.01_macro' of 'case.01_macro' as the suffix
+                    macro_name = Path(output_directory).joinpath(slide.stem + '_macro.jpg')
+                    label.save_raw_image(macro_name, 'macro')
+            else:
+                img = label.get_label()
+                img.save(save_name)
         except Exception as e:
             print(e)
 
+def pack_labels(slides, pack_path, raw: bool=False, include_macro: bool=False):
+    """Appends the labels of slides to a label pack (see utils.labelpack) instead of writing one
+    file per slide. Labels and macros already in the pack are skipped, so an interrupted export
+    can be resumed by running it again. Must be run before removing the labels.
+
+    Args:
+        slides (iterable): paths of the slides. The file name without suffix is the slide id
+        pack_path (str): path of the pack. Created if it does not exist
+        raw (bool, optional): store the compressed label strip as is (see get_raw_image) instead of
+        re-encoding the label as JPEG. Defaults to False.
+        include_macro (bool, optional): also store the raw macro. Requires raw. Defaults to False.
+
+    Raises:
+        ValueError: If include_macro is set without raw
+
+    Returns:
+        int: number of slides added
+    """
+    if include_macro and not raw:
+        raise ValueError('The macro can only be exported raw')
+    image_types = ['label', 'macro'] if include_macro else ['label']
+
+    added = 0
+    with LabelPackWriter(pack_path) as pack:
+        for slide in slides:
+            slide_id = Path(slide).stem
+            missing = [image_type for image_type in image_types if (slide_id, image_type) not in pack]
+            if not missing:
+                continue
+            try:
+                btf = BigTiffFile(slide)
+                if raw:
+                    for image_type in missing:
+                        img, extension = btf.get_raw_image(image_type)
+                        pack.add(slide_id, img.getvalue(), extension, image_type)
+                else:
+                    img = io.BytesIO()
+                    btf.get_label().save(img, format='JPEG')
+                    pack.add(slide_id, img.getvalue(), '.jpg')
+                added += 1
+            except Exception as e:
+                print(e)
+    return added
+
+
+def _reduced_image(slide: BigTiffFile, image_type: str, thumbnail_size):
+    img, extension = slide.get_raw_image(image_type)
+    img = Image.open(img)
+    if extension == '.jpg':
+        # lets the JPEG decoder scale by 1/2, 1/4 or 1/8 instead of decoding full size
+        img.draft('RGB', thumbnail_size)
+    img.thumbnail(thumbnail_size)
+    return img
+
+
+def _contact_sheet_images(slide_path, thumbnail_size, include_macro):
+    slide = BigTiffFile(slide_path)
+    images = [_reduced_image(slide, 'label', thumbnail_size)]
+    if include_macro:
+        images.append(_reduced_image(slide, 'macro', thumbnail_size))
+    return images
+
+
+def _add_contact_sheet_cell(sheet: ContactSheet, slide_path, future):
+    caption = Path(slide_path).name
+    try:
+        images = future.result()
+    except Exception as e:
+        print(f'{slide_path}: {e}')
+        images = []
+        caption = caption + ' (failed)'
+    sheet.add(caption, images)
+
+
+def create_contact_sheets(slides, output_directory, include_macro: bool=False, columns: int=8, rows: int=6,
+    thumbnail_size=(256, 256), max_workers: int=None):
+    """Extracts the labels (and optionally macros) of many slides in parallel and tiles them
+    into paged contact sheets captioned with the file names. Labels and macros are downsampled
+    while decoding where possible. Slides are consumed lazily and only a few are in flight
+    at once, so memory use does not grow with the number of slides.
+
+    Args:
+        slides (iterable): paths to SVS files
+        output_directory (str): directory to save the contact sheet pages
+        include_macro (bool, optional): place the macro next to the label. Defaults to False.
+        columns (int, optional): slides per row. Defaults to 8.
+        rows (int, optional): rows per page. Defaults to 6.
+        thumbnail_size (tuple, optional): maximum (width, height) of each thumbnail. Defaults to (256, 256).
+        max_workers (int, optional): number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: paths of the saved pages
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_workers * 4
+    images_per_cell = 2 if include_macro else 1
+
+    sheet = ContactSheet(output_directory, columns, rows, thumbnail_size, images_per_cell)
+    with sheet, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for slide_path in slides:
+            future = executor.submit(_contact_sheet_images, slide_path, thumbnail_size, include_macro)
+            pending.append((slide_path, future))
+            if len(pending) >= max_pending:
+                _add_contact_sheet_cell(sheet, *pending.popleft())
+
+        while pending:
+            _add_contact_sheet_cell(sheet, *pending.popleft())
+
+    return sheet.pages
+
+
+def contact_sheets(args: argparse.Namespace):
+    path = Path(args.path)
+    if path.is_dir():
+        slides = sorted(path.glob('*.svs'))
+    else:
+        _error = f'{path} is not a valid directory'
+        raise ValueError(_error)
+
+    pages = create_contact_sheets(
+        slides,
+        output_directory=args.outdir,
+        include_macro=args.macro,
+        columns=args.columns,
+        rows=args.rows,
+        thumbnail_size=(args.size, args.size),
+        max_workers=args.workers
+    )
+    print(f'Saved {len(pages)} contact sheet page(s) to {args.outdir}')
+
+
+def _audit_from_args(args: argparse.Namespace):
+    audit_log = None
+    archive = None
+    if args.audit is not None:
+        audit_log = AuditLog(args.audit)
+    if args.archive is not None:
+        if args.key is None:
+            raise ValueError('-key is required to write an encrypted archive')
+        archive = EncryptedArchiveSink(args.archive, _read_key(args.key))
+    return audit_log, archive
+
+
+def _read_key(key_path):
+    # a hex key is text (whitespace around it is ignored), anything else is used byte for byte
+    with open(key_path, 'rb') as key_file:
+        key = key_file.read()
+    hex_key = key.strip()
+    if len(hex_key) in (32, 48, 64) and all(character in HEX_DIGITS for character in hex_key):
+        return bytes.fromhex(hex_key.decode('ascii'))
+    return key
+
+
+def _label_cache_from_args(args: argparse.Namespace):
+    if args.cache is None:
+        return None
+    return LabelCache(args.cache, max_bytes=args.cache_size * 1024 * 1024)
+
+
+def watch_folder_daemon(args: argparse.Namespace):
+    lookup = None
+    if args.manifest is not None:
+        lookup = ManifestLookup(args.manifest, args.hd)
+    elif args.lookup is not None:
+        lookup = _load_lookup(args.lookup)
+
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
+
+    stop_event = threading.Event()
+    def _stop(signum, frame):
+        print('Stopping - waiting for slides in progress to finish')
+        stop_event.set()
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    watch_folder(
+        args.dirs,
+        lookup=lookup,
+        output_dir=args.outdir,
+        max_workers=args.workers,
+        poll_interval=args.poll,
+        settle_seconds=args.settle,
+        use_inotify=not args.no_inotify,
+        audit_log=AuditLog(args.audit) if args.audit is not None else None,
+        label_cache=_label_cache_from_args(args),
+        stop_event=stop_event,
+        metrics_file=args.metrics_file,
+        lock=args.lock
+    )
+
+
+def stream_slide(args: argparse.Namespace):
+    label_params = None
+    if args.switch:
+        label_params = [args.qr, args.l1, args.l2, args.l3, args.l4]
+    summary = stream_de_identify(sys.stdin.buffer, sys.stdout.buffer, label_params=label_params,
+        label_cache=_label_cache_from_args(args), window=args.window * 1024 * 1024)
+    # stdout carries the slide
+    print(f'Streamed {summary["bytes written"]} bytes, held at most {summary["max buffered"]} bytes', file=sys.stderr)
+
+
 def single_slide_switch_labels(args: argparse.Namespace):
+    audit_log, archive = _audit_from_args(args)
     label_switcher = LabelSwitcher(
         slide_path=args.p,
         remove_original_label_and_macro=True,
@@ -543,17 +1662,40 @@ def single_slide_switch_labels(args: argparse.Namespace):
         text_line1=args.l1,
         text_line2=args.l1,
         text_line3=args.l1,
-        text_line4=args.l1)
+        text_line4=args.l1,
+        audit_log=audit_log,
+        archive=archive,
+        label_cache=_label_cache_from_args(args),
+        compact=args.compact)
 
     label_switcher.switch_labels()
+    if args.compact:
+        print(_compaction_message(label_switcher.bytes_saved))
+    if archive is not None:
+        archive.close()
 
 
 def multiple_slide_switch_labels(args: argparse.Namespace):
+    audit_log, archive = _audit_from_args(args)
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
     switch_labels_from_file(
         file_path=args.p,
         col_with_slide_names=args.hd,
-        slide_dir=args.dir
+        slide_dir=args.dir,
+        audit_log=audit_log,
+        archive=archive,
+        label_cache=_label_cache_from_args(args),
+        max_workers=args.workers,
+        compact=args.compact,
+        shard=args.shard,
+        lock=args.lock,
+        locality=args.locality
     )
+    if archive is not None:
+        archive.close()
+    if args.metrics_file is not None:
+        METRICS.write_textfile(args.metrics_file)
 
 
 
@@ -579,6 +1721,12 @@ if __name__ == '__main__':
     single.add_argument('-l2', help='Line 2 text', default=None, metavar='Line 2')
     single.add_argument('-l3', help='Line 3 text', default=None, metavar='Line 3')
     single.add_argument('-l4', help='Line 4 text', default=None, metavar='Line 4')
+    single.add_argument('-audit', help='Append SHA-256 digests of the wiped label and macro to this audit log', default=None)
+    single.add_argument('-archive', help='Keep an encrypted copy of the wiped bytes in this archive', default=None)
+    single.add_argument('-key', help='File with the AES key (raw or hex) for -archive', default=None)
+    single.add_argument('-compact', help='Reuse the space of the original label and macro and truncate the file', action='store_true')
+    single.add_argument('-cache', help='Directory of the encoded label cache', default=None)
+    single.add_argument('-cache_size', help='Size limit of the label cache in MB', type=int, default=1024)
     single.set_defaults(func=single_slide_switch_labels)
 
 
@@ -601,6 +1749,70 @@ if __name__ == '__main__':
         help='path to slide directory - optional (useful if files have switched directories, but names have not)', 
         default=None
         )
+    multiple.add_argument(
+        '-audit',
+        help='Append SHA-256 digests of the wiped labels and macros to this audit log',
+        default=None
+        )
+    multiple.add_argument(
+        '-archive',
+        help='Keep an encrypted copy of the wiped bytes in this archive',
+        default=None
+        )
+    multiple.add_argument(
+        '-key',
+        help='File with the AES key (raw or hex) for -archive',
+        default=None
+        )
+    multiple.add_argument(
+        '-workers',
+        help='Number of worker processes - 0 switches one slide at a time in this process',
+        type=int,
+        default=0
+        )
+    multiple.add_argument(
+        '-compact',
+        help='Reuse the space of the original labels and macros and truncate the files',
+        action='store_true'
+        )
+    multiple.add_argument(
+        '-cache',
+        help='Directory of the encoded label cache - slides with the same label text reuse the encoded label',
+        default=None
+        )
+    multiple.add_argument(
+        '-cache_size',
+        help='Size limit of the label cache in MB',
+        type=int,
+        default=1024
+        )
+    multiple.add_argument(
+        '-metrics_port',
+        help='Serve Prometheus metrics on this local port while the batch runs',
+        type=int,
+        default=None
+        )
+    multiple.add_argument(
+        '-metrics_file',
+        help='Write Prometheus metrics to this file for node_exporter when the batch finishes',
+        default=None
+        )
+    multiple.add_argument(
+        '-shard',
+        help='Only switch the slides of this shard, e.g. 2/4 on the second of four nodes sharing the manifest',
+        type=parse_shard,
+        default=None
+        )
+    multiple.add_argument(
+        '-lock',
+        help='Lock each slide while it is switched so concurrent runs never rewrite the same slide',
+        action='store_true'
+        )
+    multiple.add_argument(
+        '-locality',
+        help='Switch the slides in order of their position on disk instead of manifest order',
+        action='store_true'
+        )
     
     multiple.set_defaults(func=multiple_slide_switch_labels)
 
@@ -617,11 +1829,94 @@ if __name__ == '__main__':
     save_label.add_argument(
         '-outdir', 
         help='Output directory to save label(s)', 
-        required=True
+        default=None
+        )
+    save_label.add_argument(
+        '-raw',
+        help='Copy the compressed label strip into a standalone TIFF/JPEG without decoding it',
+        action='store_true'
+        )
+    save_label.add_argument(
+        '-macro',
+        help='Also export the macro image - requires -raw',
+        action='store_true'
+        )
+    save_label.add_argument(
+        '-pack',
+        help='Append the labels to this pack file instead of writing one file per slide - resumes an interrupted export',
+        default=None
         )
     save_label.set_defaults(func=label_saver)
 
 
+    contact = subparsers.add_parser(
+        'contact',
+        help='Tile the labels of all slides in one directory into paged contact sheets for QC'
+        )
+    contact.add_argument(
+        '-path',
+        help='Path to directory containing SVS files in BigTiff format',
+        required=True
+        )
+    contact.add_argument(
+        '-outdir',
+        help='Output directory to save the contact sheet pages',
+        required=True
+        )
+    contact.add_argument('-macro', help='Place the macro next to each label', action='store_true')
+    contact.add_argument('-columns', help='Slides per row', type=int, default=8)
+    contact.add_argument('-rows', help='Rows per page', type=int, default=6)
+    contact.add_argument('-size', help='Maximum thumbnail width and height in pixels', type=int, default=256)
+    contact.add_argument('-workers', help='Number of worker processes', type=int, default=None)
+    contact.set_defaults(func=contact_sheets)
+
+
+    watch = subparsers.add_parser(
+        'watch',
+        help='Watch scanner output directories and de-identify new slides as soon as they are written'
+        )
+    watch.add_argument('-dirs', help='Directories to watch', nargs='+', required=True)
+    watch.add_argument('-outdir', help='Move processed slides to this directory', default=None)
+    watch.add_argument(
+        '-manifest',
+        help='csv or xlsx file with the label text - slides without an entry are only de-identified',
+        default=None
+        )
+    watch.add_argument('-hd', help='Manifest column with the slide names', default='File Location')
+    watch.add_argument(
+        '-lookup',
+        help='Label lookup function as module:function - called with the slide path, returns label arguments or None',
+        default=None
+        )
+    watch.add_argument('-workers', help='Number of worker processes', type=int, default=None)
+    watch.add_argument('-poll', help='Seconds between directory checks', type=float, default=5.0)
+    watch.add_argument('-settle', help='Seconds a slide must be unchanged before it is processed', type=float, default=10.0)
+    watch.add_argument('-no_inotify', help='Always poll the directories (e.g. on network shares)', action='store_true')
+    watch.add_argument('-audit', help='Append SHA-256 digests of the wiped labels and macros to this audit log', default=None)
+    watch.add_argument('-cache', help='Directory of the encoded label cache', default=None)
+    watch.add_argument('-cache_size', help='Size limit of the label cache in MB', type=int, default=1024)
+    watch.add_argument('-metrics_port', help='Serve Prometheus metrics on this local port', type=int, default=None)
+    watch.add_argument('-metrics_file', help='Write Prometheus metrics to this file for node_exporter', default=None)
+    watch.add_argument('-lock', help='Lock each slide while it is processed', action='store_true')
+    watch.set_defaults(func=watch_folder_daemon)
+
+
+    stream = subparsers.add_parser(
+        'stream',
+        help='De-identify a slide read from stdin and write it to stdout'
+        )
+    stream.add_argument('-switch', help='Replace the label and macro instead of only zeroing them', action='store_true')
+    stream.add_argument('-qr', help='QR code text', default=None)
+    stream.add_argument('-l1', help='Line 1 text', default=None, metavar='Line 1')
+    stream.add_argument('-l2', help='Line 2 text', default=None, metavar='Line 2')
+    stream.add_argument('-l3', help='Line 3 text', default=None, metavar='Line 3')
+    stream.add_argument('-l4', help='Line 4 text', default=None, metavar='Line 4')
+    stream.add_argument('-window', help='MB held back until the IFDs referencing them are read', type=int, default=32)
+    stream.add_argument('-cache', help='Directory of the encoded label cache', default=None)
+    stream.add_argument('-cache_size', help='Size limit of the label cache in MB', type=int, default=1024)
+    stream.set_defaults(func=stream_slide)
+
+
     args = parser.parse_args()
     args.func(args)
 
@@ -0,0 +1,65 @@
+import io
+from pathlib import Path
+import struct
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.streaming import StreamingDeidentifier
+
+
+def _classic_tiff(directories):
+    """Classic TIFF with each IFD directly followed by its data, like an Aperio slide.
+
+    Args:
+        directories (list): (compression, data, tiled) of each directory in chain order
+
+    Returns:
+        tuple: TIFF bytes and the (offset, size) of the data of each directory
+    """
+    tiff = bytearray(b'II' + struct.pack('<HL', 42, 8))
+    extents = []
+    for index, (compression, data, tiled) in enumerate(directories):
+        offsets_tag, counts_tag = (324, 325) if tiled else (273, 279)
+        entries = [(256, 4, 1, 256), (257, 4, 1, 256), (259, 3, 1, compression)]
+        if tiled:
+            entries += [(322, 4, 1, 256), (323, 4, 1, 256)]
+        ifd_size = 2 + (len(entries) + 2) * 12 + 4
+        data_offset = len(tiff) + ifd_size
+        entries += [(offsets_tag, 4, 1, data_offset), (counts_tag, 4, 1, len(data))]
+        next_ifd = 0 if index == len(directories) - 1 else data_offset + len(data) + len(data) % 2
+
+        tiff += struct.pack('<H', len(entries))
+        for tag, ifd_type, count, value in sorted(entries):
+            tiff += struct.pack('<HHLL', tag, ifd_type, count, value)
+        tiff += struct.pack('<L', next_ifd)
+        tiff += data + bytes(len(data) % 2)
+        extents.append((data_offset, len(data)))
+    return bytes(tiff), extents
+
+
+def test_thumbnail_before_large_level_streams_in_constant_memory():
+    level_size = 8 * 1024 * 1024
+    window = 1024 * 1024
+    slide, extents = _classic_tiff([
+        (7, b'\x01' * 4096, True),
+        # single strip thumbnail right after level 0
+        (7, b'\x02' * 4096, False),
+        (7, b'\x03' * level_size, True),
+        # LZW label and JPEG macro
+        (5, b'\x04' * 2048, False),
+        (7, b'\x05' * 3072, False)
+    ])
+
+    output = io.BytesIO()
+    summary = StreamingDeidentifier(window=window, chunk_size=64 * 1024).run(io.BytesIO(slide), output)
+
+    assert summary['max buffered'] < 2 * window
+    (label_offset, label_size), (macro_offset, macro_size) = extents[3:]
+    assert summary['label'] == {'offset': label_offset, 'size': label_size}
+    assert summary['macro'] == {'offset': macro_offset, 'size': macro_size}
+
+    expected = bytearray(slide)
+    expected[label_offset:label_offset + label_size] = bytes(label_size)
+    expected[macro_offset:macro_offset + macro_size] = bytes(macro_size)
+    assert output.getvalue() == bytes(expected)
@@ -0,0 +1,87 @@
+import re
+
+# e.g. '46000x32914 [0,100 46000x32814] (256x256) JPEG/RGB Q=70', 'label 609x567'
+DIMENSIONS_PATTERN = re.compile(r'(\d+)\s*x\s*(\d+)')
+TILE_SIZE_PATTERN = re.compile(r'\((\d+)x(\d+)\)')
+
+# Aperio fields converted to numbers
+NUMERIC_FIELDS = {
+    'AppMag': 'app mag',
+    'MPP': 'mpp',
+    'Exposure Time': 'exposure time',
+    'Exposure Scale': 'exposure scale',
+    'Left': 'left',
+    'Top': 'top',
+    'StripeWidth': 'stripe width'
+}
+TEXT_FIELDS = {
+    'ScanScope ID': 'scanscope id',
+    'Date': 'date',
+    'Time': 'time',
+    'Time Zone': 'time zone',
+    'Filename': 'filename',
+    'User': 'user'
+}
+
+
+def parse_image_description(description):
+    """Parses an Aperio ImageDescription (tag 270), e.g.
+    'Aperio Image Library v12.0.15 \\r\\n46000x32914 [0,100 46000x32814] (256x256) JPEG/RGB Q=70|AppMag = 20|MPP = 0.499|...'
+
+    Args:
+        description (bytes | str): raw tag value
+
+    Returns:
+        dict: 'software', 'summary' (line after the software), 'image type' ('label', 'macro' or None),
+        'dimensions' (width, height), 'tile size' (width, height), 'fields' (all key = value pairs as strings)
+        and the common fields with lower case names: 'app mag' and 'mpp' as floats, 'scanscope id', 'date', ...
+        Keys that are not in the description are None.
+    """
+    if isinstance(description, (bytes, bytearray)):
+        description = bytes(description).rstrip(b'\0').decode('UTF-8', errors='replace')
+
+    segments = description.split('|')
+    header_lines = [line.strip() for line in segments[0].splitlines() if line.strip()]
+    software = header_lines[0] if header_lines else None
+    summary = ' '.join(header_lines[1:]) if len(header_lines) > 1 else None
+
+    parsed = {
+        'software': software,
+        'summary': summary,
+        'image type': None,
+        'dimensions': None,
+        'tile size': None,
+        'fields': {}
+    }
+    for field_name in list(NUMERIC_FIELDS.values()) + list(TEXT_FIELDS.values()):
+        parsed[field_name] = None
+
+    if summary is not None:
+        first_word = summary.split()[0].lower()
+        if first_word in ('label', 'macro'):
+            parsed['image type'] = first_word
+        dimensions = DIMENSIONS_PATTERN.search(summary)
+        if dimensions is not None:
+            parsed['dimensions'] = (int(dimensions.group(1)), int(dimensions.group(2)))
+        tile_size = TILE_SIZE_PATTERN.search(summary)
+        if tile_size is not None:
+            parsed['tile size'] = (int(tile_size.group(1)), int(tile_size.group(2)))
+    elif software is not None and software.split()[0].lower() in ('label', 'macro'):
+        # descriptions written without the software line
+        parsed['image type'] = software.split()[0].lower()
+
+    for segment in segments[1:]:
+        key, separator, value = segment.partition('=')
+        if not separator:
+            continue
+        key = key.strip()
+        value = value.strip()
+        parsed['fields'][key] = value
+        if key in NUMERIC_FIELDS:
+            try:
+                parsed[NUMERIC_FIELDS[key]] = float(value)
+            except ValueError:
+                pass
+        elif key in TEXT_FIELDS:
+            parsed[TEXT_FIELDS[key]] = value
+    return parsed
@@ -0,0 +1,142 @@
+from datetime import datetime, timezone
+import json
+import os
+import struct
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+ARCHIVE_MAGIC = b'SVSA'
+# slide name length, region name length, file offset of the chunk, ciphertext length
+ARCHIVE_FRAME_HEADER = '<HHQI'
+NONCE_SIZE = 12
+
+
+def utc_timestamp():
+    """Current time as an ISO 8601 string in UTC
+    """
+    return datetime.now(timezone.utc).isoformat()
+
+
+class AuditLog():
+    def __init__(self, log_path) -> None:
+        """Batch level audit log. Each record is appended as a single JSON line so
+        records written by several processes do not interleave.
+
+        Args:
+            log_path (str): path to the audit log. Created if it does not exist
+        """
+        self.log_path = log_path
+
+    def append(self, record: dict):
+        """Appends a record to the log and flushes it to disk.
+
+        Args:
+            record (dict): JSON serializable audit record
+        """
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('UTF-8')
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def records(self):
+        """Yields the records in the log in the order they were written
+        """
+        with open(self.log_path, 'r', encoding='UTF-8') as log:
+            for line in log:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class EncryptedArchiveSink():
+    def __init__(self, archive_path, key: bytes) -> None:
+        """Keeps an encrypted copy of the label and macro bytes that are destroyed by
+        de_identify_slide. Every chunk is sealed with AES-GCM and appended to the archive
+        as a frame. The slide, region and offset of the chunk are authenticated with it.
+        Requires the cryptography package.
+
+        Args:
+            archive_path (str): path to the archive. Frames are appended if it exists
+            key (bytes): 16, 24 or 32 byte AES key
+
+        Raises:
+            ImportError: If cryptography is not installed
+        """
+        if AESGCM is None:
+            raise ImportError('The cryptography package is required for encrypted archives')
+        self.archive_path = archive_path
+        self._aesgcm = AESGCM(key)
+        self._archive = open(archive_path, 'ab')
+
+    def write(self, slide: str, region: str, offset: int, chunk: bytes):
+        """Encrypts a chunk and appends it to the archive.
+
+        Args:
+            slide (str): slide path or identifier
+            region (str): 'label' or 'macro'
+            offset (int): offset of the chunk in the slide
+            chunk (bytes): original bytes
+        """
+        slide = slide.encode('UTF-8')
+        region = region.encode('UTF-8')
+        nonce = os.urandom(NONCE_SIZE)
+        associated_data = slide + b'\0' + region + struct.pack('<Q', offset)
+        ciphertext = self._aesgcm.encrypt(nonce, chunk, associated_data)
+
+        header = struct.pack(ARCHIVE_FRAME_HEADER, len(slide), len(region), offset, len(ciphertext))
+        self._archive.write(ARCHIVE_MAGIC + header + nonce + slide + region + ciphertext)
+
+    def flush(self):
+        """Writes the frames appended so far to disk. Called before the original bytes are overwritten
+        """
+        self._archive.flush()
+        os.fsync(self._archive.fileno())
+
+    def close(self):
+        self.flush()
+        self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_archive(archive_path, key: bytes):
+    """Decrypts an archive written by EncryptedArchiveSink.
+
+    Args:
+        archive_path (str): path to the archive
+        key (bytes): key used to write the archive
+
+    Yields:
+        tuple: (slide, region, offset, chunk)
+    """
+    if AESGCM is None:
+        raise ImportError('The cryptography package is required for encrypted archives')
+    aesgcm = AESGCM(key)
+    header_size = struct.calcsize(ARCHIVE_FRAME_HEADER)
+
+    with open(archive_path, 'rb') as archive:
+        while True:
+            magic = archive.read(len(ARCHIVE_MAGIC))
+            if not magic:
+                break
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(f'{archive_path} is not a label archive or is corrupt')
+            slide_length, region_length, offset, ciphertext_length = struct.unpack(
+                ARCHIVE_FRAME_HEADER, archive.read(header_size))
+            nonce = archive.read(NONCE_SIZE)
+            slide = archive.read(slide_length)
+            region = archive.read(region_length)
+            ciphertext = archive.read(ciphertext_length)
+
+            associated_data = slide + b'\0' + region + struct.pack('<Q', offset)
+            chunk = aesgcm.decrypt(nonce, ciphertext, associated_data)
+            yield slide.decode('UTF-8'), region.decode('UTF-8'), offset, chunk
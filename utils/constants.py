@@ -22,6 +22,7 @@ TAGNAMES = {
     323: 'TileLength',
     324: 'TileOffsets',
     325: 'TileByteCounts',
+    347: 'JPEGTables',
     32997: 'ImageDepth', 
     34675: 'TiffTag_ICCProfile'
 }
@@ -71,4 +72,25 @@ FORMAT_CHARACTERS = {
     11: 'f',
     12: 'd',
     16: 'Q'
-}
\ No newline at end of file
+}
+
+# byte layout of classic TIFF and BigTIFF: header size, IFD entry count, IFD entry
+# (tag, type, count) and offsets / values stored in the IFD entry
+CLASSIC_TIFF = {
+    'version': 42,
+    'header_size': 8,
+    'count': '<H',
+    'entry': '<HHL',
+    'offset': '<L'
+}
+
+BIG_TIFF = {
+    'version': 43,
+    'header_size': 16,
+    'count': '<Q',
+    'entry': '<HHQ',
+    'offset': '<Q'
+}
+
+# largest offset that fits in a classic TIFF
+CLASSIC_TIFF_MAX_OFFSET = 2 ** 32 - 1
@@ -0,0 +1,96 @@
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+
+class ContactSheet():
+    def __init__(self, output_directory, columns: int=8, rows: int=6, thumbnail_size=(256, 256),
+        images_per_cell: int=1, caption_height: int=16, name: str='contact_sheet') -> None:
+        """Tiles label (and macro) thumbnails into paged mosaic images with a caption
+        under each cell. Only the page being filled is kept in memory; full pages are
+        written to the output directory as they are completed.
+
+        Args:
+            output_directory (str): directory to save the pages
+            columns (int, optional): cells per row. Defaults to 8.
+            rows (int, optional): rows per page. Defaults to 6.
+            thumbnail_size (tuple, optional): maximum (width, height) of each thumbnail. Defaults to (256, 256).
+            images_per_cell (int, optional): thumbnails placed side by side in one cell. Defaults to 1.
+            caption_height (int, optional): height in pixels reserved for the caption. Defaults to 16.
+            name (str, optional): file name prefix of the pages. Defaults to 'contact_sheet'.
+        """
+        self.output_directory = Path(output_directory)
+        self.columns = columns
+        self.rows = rows
+        self.thumbnail_size = thumbnail_size
+        self.caption_height = caption_height
+        self.name = name
+
+        self.cell_size = (thumbnail_size[0] * images_per_cell, thumbnail_size[1] + caption_height)
+        self.page_size = (self.cell_size[0] * columns, self.cell_size[1] * rows)
+        self.font = ImageFont.load_default()
+
+        self.pages = []
+        self._page = None
+        self._cell = 0
+
+    def add(self, caption: str, images):
+        """Adds one cell to the contact sheet.
+
+        Args:
+            caption (str): text written under the thumbnails, usually the slide name
+            images (list): PIL Images to place side by side. None leaves the position blank
+        """
+        if self._page is None:
+            self._page = Image.new('RGB', self.page_size, 'white')
+            self._cell = 0
+
+        column = self._cell % self.columns
+        row = self._cell // self.columns
+        x = column * self.cell_size[0]
+        y = row * self.cell_size[1]
+
+        for position, img in enumerate(images):
+            if img is None:
+                continue
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail(self.thumbnail_size)
+            self._page.paste(img, (x + position * self.thumbnail_size[0], y))
+
+        img_draw = ImageDraw.Draw(self._page)
+        img_draw.text((x + 2, y + self.thumbnail_size[1] + 2), self._fit_caption(caption, img_draw),
+            font=self.font, fill=(0, 0, 0))
+
+        self._cell += 1
+        if self._cell == self.columns * self.rows:
+            self._save_page()
+
+    def close(self):
+        """Saves the last, partially filled page.
+
+        Returns:
+            list: paths of all saved pages
+        """
+        if self._page is not None:
+            self._save_page()
+        return self.pages
+
+    def _fit_caption(self, caption, img_draw):
+        max_width = self.cell_size[0] - 4
+        if img_draw.textlength(caption, font=self.font) <= max_width:
+            return caption
+        while caption and img_draw.textlength('...' + caption, font=self.font) > max_width:
+            caption = caption[1:]
+        return '...' + caption
+
+    def _save_page(self):
+        save_name = self.output_directory.joinpath(f'{self.name}_{len(self.pages) + 1:04d}.jpg')
+        self._page.save(save_name, quality=85)
+        self.pages.append(save_name)
+        self._page = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import struct
+import tempfile
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_MAGIC = b'SVLC'
+# magic, image width, image height
+CACHE_HEADER = '<4sLL'
+CACHE_SUFFIX = '.lbl'
+# without fcntl, an eviction lock older than this is assumed to belong to a dead process
+STALE_LOCK_SECONDS = 60
+
+
+class LabelCache():
+    def __init__(self, cache_dir, max_bytes: int=1024 ** 3) -> None:
+        """Persistent content addressed cache of encoded label and macro images. Entries
+        are keyed by a hash of everything that changes the encoded bytes, so slides that
+        share a label payload only pay for offset patching and the write.
+
+        Entries are written to a temporary file and renamed into place, so readers in other
+        processes never see partial entries. When the cache grows past max_bytes the least
+        recently used entries are removed by whichever process holds the eviction lock.
+
+        Args:
+            cache_dir (str): directory to store the cache. Created if it does not exist
+            max_bytes (int, optional): size limit of the cache. Defaults to 1 GiB.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(**params):
+        """Hashes the parameters that determine an encoded image.
+
+        Returns:
+            str: hex digest used as the cache key
+        """
+        payload = json.dumps(params, sort_keys=True, default=str).encode('UTF-8')
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, key: str):
+        """Looks up an encoded image and marks it as recently used.
+
+        Args:
+            key (str): cache key from LabelCache.key
+
+        Returns:
+            tuple | None: (encoded bytes, (width, height)) or None if the key is not cached
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry:
+                data = entry.read()
+            os.utime(entry_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        header_size = struct.calcsize(CACHE_HEADER)
+        magic, width, height = struct.unpack(CACHE_HEADER, data[:header_size])
+        if magic != CACHE_MAGIC:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data[header_size:], (width, height)
+
+    def put(self, key: str, data: bytes, dimensions):
+        """Stores an encoded image.
+
+        Args:
+            key (str): cache key from LabelCache.key
+            data (bytes): encoded image
+            dimensions (tuple): (width, height) of the image
+        """
+        header = struct.pack(CACHE_HEADER, CACHE_MAGIC, *dimensions)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                entry.write(header)
+                entry.write(data)
+            os.replace(temp_path, self._entry_path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _entry_path(self, key):
+        return self.cache_dir.joinpath(key + CACHE_SUFFIX)
+
+    def _evict(self):
+        lock_path = self.cache_dir.joinpath('.evict.lock')
+        lock = self._lock_eviction(lock_path)
+        if lock is None:
+            # another process is already evicting
+            return
+
+        try:
+            entries = []
+            total_size = 0
+            for entry_path in self.cache_dir.glob('*' + CACHE_SUFFIX):
+                try:
+                    stat = entry_path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+
+            entries.sort()
+            for _, size, entry_path in entries:
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+        finally:
+            # closing the file releases the flock
+            os.close(lock)
+            if fcntl is None:
+                os.remove(lock_path)
+
+    def _lock_eviction(self, lock_path):
+        if fcntl is not None:
+            # the cache is local, so flock works. The kernel releases it when the owner dies, so
+            # there are no stale locks and the lock file is never removed
+            lock = os.open(lock_path, os.O_CREAT | os.O_WRONLY, 0o644)
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock)
+                return None
+            return lock
+
+        try:
+            return os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self._break_stale_lock(lock_path)
+            return None
+
+    def _break_stale_lock(self, lock_path):
+        # like SlideLock, the lock is renamed away and compared with the one judged stale, so a
+        # lock another process took in between is put back instead of removed
+        try:
+            stale = os.stat(lock_path)
+        except FileNotFoundError:
+            return
+        if time.time() - stale.st_mtime <= STALE_LOCK_SECONDS:
+            return
+        stale_path = lock_path.with_name(f'{lock_path.name}.{uuid.uuid4().hex}.stale')
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return
+        moved = os.stat(stale_path)
+        if (moved.st_ino, moved.st_mtime_ns) != (stale.st_ino, stale.st_mtime_ns):
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+        os.remove(stale_path)
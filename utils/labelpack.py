@@ -0,0 +1,281 @@
+from bisect import bisect_left
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+import zlib
+
+RECORD_MAGIC = b'SVLR'
+# magic, slide id length, image type, extension length, data length, CRC-32 of the data
+RECORD_HEADER = '<4sHBBQI'
+INDEX_MAGIC = b'SVLI'
+INDEX_VERSION = 1
+# magic, version, number of entries, size of the pack covered by the index
+INDEX_HEADER = '<4sHQQ'
+# hash of slide id and image type, offset of the record
+INDEX_ENTRY = '<QQ'
+INDEX_SUFFIX = '.idx'
+
+IMAGE_TYPES = ('label', 'macro')
+
+
+def _key_hash(slide_id: str, image_type: str):
+    digest = hashlib.sha256(f'{slide_id}\0{image_type}'.encode('UTF-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def _scan_records(pack, pack_size):
+    """Yields (offset, slide id, image type, extension, data offset, data length) of each complete
+    record and stops at the first incomplete or corrupt one. Only record headers are read.
+    """
+    header_size = struct.calcsize(RECORD_HEADER)
+    offset = 0
+    while offset + header_size <= pack_size:
+        pack.seek(offset)
+        magic, id_length, type_code, extension_length, data_length, _ = struct.unpack(
+            RECORD_HEADER, pack.read(header_size))
+        data_offset = offset + header_size + id_length + extension_length
+        if magic != RECORD_MAGIC or type_code >= len(IMAGE_TYPES) or data_offset + data_length > pack_size:
+            break
+        slide_id = pack.read(id_length).decode('UTF-8')
+        extension = pack.read(extension_length).decode('UTF-8')
+        yield offset, slide_id, IMAGE_TYPES[type_code], extension, data_offset, data_length
+        offset = data_offset + data_length
+
+
+def pack_index_path(pack_path):
+    return Path(str(pack_path) + INDEX_SUFFIX)
+
+
+class LabelPackWriter():
+    def __init__(self, pack_path) -> None:
+        """Appends labels and macros of many slides to one pack file instead of writing one small
+        file per slide. Each record holds the slide id, image type, file extension and the encoded
+        image. When the writer is closed a sorted index (pack_path + '.idx') is written next to the
+        pack for random access with LabelPackReader.
+
+        An existing pack is resumed: its records are scanned, a record cut short by an interrupted
+        export is truncated and new records are appended after the last complete one.
+
+        Args:
+            pack_path (str): path to the pack. Created if it does not exist
+        """
+        self.pack_path = Path(pack_path)
+        # (slide id, image type): record offset, later records replace earlier ones
+        self._records = {}
+        self._pack = open(self.pack_path, 'ab+')
+        pack_size = self._pack.seek(0, os.SEEK_END)
+        end = 0
+        for offset, slide_id, image_type, _, data_offset, data_length in _scan_records(self._pack, pack_size):
+            self._records[(slide_id, image_type)] = offset
+            end = data_offset + data_length
+        if end < pack_size:
+            print(f'Warning: removing {pack_size - end} bytes of an incomplete record from {self.pack_path}')
+            self._pack.truncate(end)
+        self._pack.seek(0, os.SEEK_END)
+
+    def __contains__(self, key):
+        """True if a slide id (label) or a (slide id, image type) tuple is in the pack
+        """
+        if isinstance(key, str):
+            key = (key, 'label')
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, slide_id: str, data: bytes, extension: str, image_type: str='label'):
+        """Appends an encoded image.
+
+        Args:
+            slide_id (str): identifier of the slide, e.g. the file name without suffix
+            data (bytes): encoded image
+            extension (str): file extension of the image, e.g. '.jpg' or '.tif'
+            image_type (str, optional): 'label' or 'macro'. Defaults to 'label'.
+        """
+        if image_type not in IMAGE_TYPES:
+            raise ValueError(f'{image_type} must be label or macro')
+        slide_id_bytes = slide_id.encode('UTF-8')
+        extension_bytes = extension.encode('UTF-8')
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, len(slide_id_bytes), IMAGE_TYPES.index(image_type),
+            len(extension_bytes), len(data), zlib.crc32(data))
+
+        offset = self._pack.tell()
+        self._pack.write(header + slide_id_bytes + extension_bytes)
+        self._pack.write(data)
+        self._records[(slide_id, image_type)] = offset
+
+    def close(self):
+        self._pack.flush()
+        os.fsync(self._pack.fileno())
+        pack_size = self._pack.tell()
+        self._pack.close()
+        self._write_index(pack_size)
+
+    def _write_index(self, pack_size):
+        entries = sorted((_key_hash(slide_id, image_type), offset) for (slide_id, image_type), offset in self._records.items())
+        index_path = pack_index_path(self.pack_path)
+        fd, temp_path = tempfile.mkstemp(dir=index_path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as index:
+                index.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION, len(entries), pack_size))
+                for entry in entries:
+                    index.write(struct.pack(INDEX_ENTRY, *entry))
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, index_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LabelPackReader():
+    def __init__(self, pack_path) -> None:
+        """Random access to a pack written by LabelPackWriter. The pack and its index are memory
+        mapped, so a lookup is a binary search over the index and a slice of the pack. If the index
+        is missing or older than the pack (e.g. the export was interrupted), the pack is scanned.
+
+        Args:
+            pack_path (str): path to the pack
+        """
+        self.pack_path = Path(pack_path)
+        with open(self.pack_path, 'rb') as pack:
+            pack_size = pack.seek(0, os.SEEK_END)
+            self._pack = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ) if pack_size else b''
+
+        self._index = None
+        self._hashes = None
+        self._entry_count = 0
+        self._load_index(pack_size)
+        if self._index is None:
+            self._build_index(pack_size)
+
+    def _load_index(self, pack_size):
+        index_path = pack_index_path(self.pack_path)
+        try:
+            index_file = open(index_path, 'rb')
+        except FileNotFoundError:
+            return
+        with index_file:
+            header_size = struct.calcsize(INDEX_HEADER)
+            header = index_file.read(header_size)
+            if len(header) < header_size:
+                return
+            magic, version, entry_count, covered_size = struct.unpack(INDEX_HEADER, header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION or covered_size != pack_size:
+                print(f'Warning: {index_path} does not match {self.pack_path}, scanning the pack')
+                return
+            self._index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._entry_count = entry_count
+        self._hashes = _IndexHashes(self._index, entry_count)
+
+    def _build_index(self, pack_size):
+        records = {}
+        with open(self.pack_path, 'rb') as pack:
+            for offset, slide_id, image_type, _, _, _ in _scan_records(pack, pack_size):
+                records[(slide_id, image_type)] = offset
+        entries = sorted((_key_hash(slide_id, image_type), offset) for (slide_id, image_type), offset in records.items())
+        self._index = b''.join(struct.pack(INDEX_ENTRY, *entry) for entry in entries)
+        self._entry_count = len(entries)
+        self._hashes = _IndexHashes(self._index, len(entries), header_size=0)
+
+    def __len__(self):
+        return self._entry_count
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            key = (key, 'label')
+        return self._find(*key) is not None
+
+    def get(self, slide_id: str, image_type: str='label'):
+        """Looks up an image.
+
+        Args:
+            slide_id (str): identifier used when the image was added
+            image_type (str, optional): 'label' or 'macro'. Defaults to 'label'.
+
+        Returns:
+            tuple | None: (bytes, extension) or None if the image is not in the pack
+        """
+        record = self._find(slide_id, image_type)
+        if record is None:
+            return None
+        _, _, extension, data_offset, data_length, _ = record
+        return bytes(self._pack[data_offset:data_offset + data_length]), extension
+
+    def verify(self, slide_id: str, image_type: str='label'):
+        """True if the CRC-32 of a stored image matches
+        """
+        record = self._find(slide_id, image_type)
+        if record is None:
+            return False
+        _, _, _, data_offset, data_length, crc = record
+        return zlib.crc32(self._pack[data_offset:data_offset + data_length]) == crc
+
+    def keys(self):
+        """Yields (slide id, image type) of every image in the pack
+        """
+        for position in range(self._entry_count):
+            slide_id, image_type, _, _, _, _ = self._read_record(self._hashes.offset(position))
+            yield slide_id, image_type
+
+    def __iter__(self):
+        return self.keys()
+
+    def _find(self, slide_id, image_type):
+        key_hash = _key_hash(slide_id, image_type)
+        position = bisect_left(self._hashes, key_hash)
+        # 64 bit hashes rarely collide, so check the stored key
+        while position < self._entry_count and self._hashes[position] == key_hash:
+            record = self._read_record(self._hashes.offset(position))
+            if record[0] == slide_id and record[1] == image_type:
+                return record
+            position += 1
+        return None
+
+    def _read_record(self, offset):
+        header_size = struct.calcsize(RECORD_HEADER)
+        _, id_length, type_code, extension_length, data_length, crc = struct.unpack_from(RECORD_HEADER, self._pack, offset)
+        position = offset + header_size
+        slide_id = bytes(self._pack[position:position + id_length]).decode('UTF-8')
+        position += id_length
+        extension = bytes(self._pack[position:position + extension_length]).decode('UTF-8')
+        position += extension_length
+        return slide_id, IMAGE_TYPES[type_code], extension, position, data_length, crc
+
+    def close(self):
+        for mapping in (self._pack, self._index):
+            if isinstance(mapping, mmap.mmap):
+                mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _IndexHashes():
+    # sequence view of the sorted hashes in an index buffer for bisect
+    def __init__(self, buffer, entry_count, header_size=None) -> None:
+        self._buffer = buffer
+        self._entry_count = entry_count
+        self._header_size = struct.calcsize(INDEX_HEADER) if header_size is None else header_size
+        self._entry_size = struct.calcsize(INDEX_ENTRY)
+
+    def __len__(self):
+        return self._entry_count
+
+    def __getitem__(self, position):
+        return struct.unpack_from(INDEX_ENTRY, self._buffer, self._header_size + position * self._entry_size)[0]
+
+    def offset(self, position):
+        return struct.unpack_from(INDEX_ENTRY, self._buffer, self._header_size + position * self._entry_size)[1]
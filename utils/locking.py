@@ -0,0 +1,146 @@
+import json
+import os
+from pathlib import Path
+import socket
+import time
+import uuid
+
+LOCK_SUFFIX = '.lock'
+# a lock older than this is assumed to belong to a dead process on another host
+STALE_LOCK_SECONDS = 60 * 60
+
+
+class SlideLockedError(RuntimeError):
+    pass
+
+
+class SlideLock():
+    def __init__(self, slide_path, stale_seconds: float=STALE_LOCK_SECONDS) -> None:
+        """Advisory lock that keeps two processes, possibly on different hosts sharing the
+        slide store over NFS, from rewriting the same slide at the same time. The lock is
+        a file next to the slide created with O_EXCL, which is atomic on local file systems
+        and NFSv3 or later.
+
+        A lock is stale if its owner ran on this host and is no longer alive, or if it is older
+        than stale_seconds. Stale locks are renamed away, checked to still be the lock that was
+        judged stale and removed before trying again.
+
+        Known limit: if another process breaks the same stale lock and takes a new one just
+        before the rename, the new lock is moved away and then linked back. If a third process
+        creates a lock while it is away, the owner of the moved lock is not told that it lost
+        the lock, and two processes rewrite the slide. This needs three processes racing for one
+        slide while its lock is stale. A warning is printed when it happens. Locks are advisory and cannot rule this out without a lock server.
+
+        Args:
+            slide_path (str): path of the slide to lock
+            stale_seconds (float, optional): age after which a lock of another host is broken. Defaults to 1 hour.
+        """
+        self.slide_path = Path(slide_path)
+        self.lock_path = Path(str(slide_path) + LOCK_SUFFIX)
+        self.stale_seconds = stale_seconds
+        self._owner = None
+
+    def acquire(self):
+        """Takes the lock without waiting.
+
+        Raises:
+            SlideLockedError: If another live process holds the lock
+        """
+        owner = {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'token': uuid.uuid4().hex,
+            'time': time.time()
+        }
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                holder = self._read_owner()
+                if holder is not None and not self._is_stale(holder):
+                    _error = f'{self.slide_path} is locked by process {holder.get("pid")} on {holder.get("host")}'
+                    raise SlideLockedError(_error)
+                self._break_stale_lock(holder)
+                continue
+
+            try:
+                os.write(fd, json.dumps(owner).encode('UTF-8'))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._owner = owner
+            return
+        raise SlideLockedError(f'{self.slide_path} is locked by another process')
+
+    def release(self):
+        """Removes the lock if it is still held by this object
+        """
+        if self._owner is None:
+            return
+        holder = self._read_owner()
+        if holder is not None and holder.get('token') == self._owner['token']:
+            try:
+                os.remove(self.lock_path)
+            except FileNotFoundError:
+                pass
+        self._owner = None
+
+    def _read_owner(self, lock_path=None):
+        lock_path = self.lock_path if lock_path is None else lock_path
+        try:
+            with open(lock_path, 'r', encoding='UTF-8') as lock:
+                return json.loads(lock.read())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # empty or partially written lock, judge it by its age
+            try:
+                return {'time': os.path.getmtime(lock_path)}
+            except FileNotFoundError:
+                return None
+
+    def _is_stale(self, holder: dict):
+        if holder.get('host') == socket.gethostname() and holder.get('pid') is not None:
+            try:
+                os.kill(holder['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return time.time() - holder.get('time', 0) > self.stale_seconds
+
+    def _break_stale_lock(self, holder: dict):
+        # Between reading the holder and the rename, another process may have broken the same
+        # stale lock and taken a new one, so the renamed file is compared with the holder
+        if holder is None:
+            # the lock was released after the failed create, just try again
+            return
+        stale_path = self.lock_path.with_name(f'{self.lock_path.name}.{uuid.uuid4().hex}.stale')
+        try:
+            os.rename(self.lock_path, stale_path)
+        except FileNotFoundError:
+            return
+
+        moved = self._read_owner(stale_path)
+        if moved is None or (moved.get('token'), moved.get('time')) == (holder.get('token'), holder.get('time')):
+            os.remove(stale_path)
+            return
+
+        # a live lock was moved, put it back unless yet another lock was created meanwhile
+        try:
+            os.link(stale_path, self.lock_path)
+        except FileExistsError:
+            # see the known limit in the class docstring, the owner of the moved lock lost it
+            print(f'Warning: the lock of process {moved.get("pid")} on {moved.get("host")} for '
+                f'{self.slide_path} was replaced by another process while a stale lock was broken')
+        finally:
+            os.remove(stale_path)
+        _error = f'{self.slide_path} is locked by process {moved.get("pid")} on {moved.get("host")}'
+        raise SlideLockedError(_error)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
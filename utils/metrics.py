@@ -0,0 +1,243 @@
+'''
+Prometheus text exposition format: https://prometheus.io/docs/instrumenting/exposition_formats/
+'''
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric():
+    def __init__(self, name: str, help_text: str, label_names=(), metric_type: str=None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.metric_type = metric_type
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def _label_text(self, key, extra=''):
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, help_text: str, label_names=()) -> None:
+        super().__init__(name, help_text, label_names, 'counter')
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render(self):
+        return [f'{self.name}{self._label_text(key)} {value}' for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    def __init__(self, name: str, help_text: str, label_names=()) -> None:
+        super().__init__(name, help_text, label_names, 'gauge')
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _render(self):
+        return [f'{self.name}{self._label_text(key)} {value}' for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text, label_names, 'histogram')
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # bucket counts (non cumulative, last one is +Inf), sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[key] = counts
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bucket == float('inf') else repr(bucket)
+                bucket_labels = self._label_text(key, 'le="' + le + '"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_text(key)} {total}')
+            lines.append(f'{self.name}_count{self._label_text(key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self) -> None:
+        """Collection of counters, gauges and histograms rendered in the Prometheus text format.
+        Recording only takes a lock and updates a dict, so it can stay enabled in hot paths.
+
+        Each process records into its own registry. Worker processes clear the values inherited
+        from the parent with reset when they start, send their counters and histograms back with
+        take_delta and the parent adds them with merge, so the parent registry holds the totals
+        for the whole batch.
+        """
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names=()):
+        return self._register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def reset(self):
+        """Clears all recorded values, e.g. the values a forked worker inherits from its parent
+        """
+        for metric in self._metrics.values():
+            with metric._lock:
+                metric._values = {}
+
+    def take_delta(self):
+        """Returns the counter and histogram values recorded since the last call and resets them.
+
+        Returns:
+            dict: picklable values to pass to merge in another process
+        """
+        delta = {}
+        for name, metric in self._metrics.items():
+            if metric.metric_type == 'gauge':
+                continue
+            with metric._lock:
+                if metric._values:
+                    delta[name] = metric._values
+                    metric._values = {}
+        return delta
+
+    def merge(self, delta: dict):
+        """Adds values from take_delta to this registry. Unknown metrics are ignored
+        """
+        for name, values in delta.items():
+            metric = self._metrics.get(name)
+            if metric is None:
+                continue
+            with metric._lock:
+                for key, value in values.items():
+                    if metric.metric_type == 'counter':
+                        metric._values[key] = metric._values.get(key, 0) + value
+                    else:
+                        counts = metric._values.setdefault(key, [[0] * (len(metric.buckets) + 1), 0.0])
+                        counts[0] = [a + b for a, b in zip(counts[0], value[0])]
+                        counts[1] += value[1]
+
+    def render(self):
+        """Renders all metrics in the Prometheus text format.
+
+        Returns:
+            str: exposition text
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            with metric._lock:
+                samples = metric._render()
+            lines.append(f'# HELP {name} {metric.help_text}')
+            lines.append(f'# TYPE {name} {metric.metric_type}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, file_path):
+        """Atomically writes the metrics for the node_exporter textfile collector.
+
+        Args:
+            file_path (str): path of the .prom file
+        """
+        directory = Path(file_path).parent
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='UTF-8') as textfile:
+                textfile.write(self.render())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def serve(self, port: int, host: str='127.0.0.1'):
+        """Serves the metrics on http://host:port/metrics from a background thread.
+
+        Returns:
+            ThreadingHTTPServer: call shutdown() to stop serving
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('UTF-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+        thread.start()
+        return server
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+METRICS = MetricsRegistry()
+
+SLIDES = METRICS.counter('svs_slides_total', 'Slides processed by outcome', ('outcome',))
+BYTES_WIPED = METRICS.counter('svs_bytes_wiped_total', 'Label and macro bytes overwritten with zeros')
+BYTES_WRITTEN = METRICS.counter('svs_bytes_written_total', 'Bytes of new labels and macros written to slides')
+BYTES_RECLAIMED = METRICS.counter('svs_bytes_reclaimed_total', 'Bytes saved by compacting the tail of slides')
+BYTES_GROWN = METRICS.counter('svs_bytes_grown_total', 'Bytes compacted slides grew by because the new label and macro are larger')
+LABEL_CACHE_REQUESTS = METRICS.counter('svs_label_cache_requests_total', 'Label cache lookups by result', ('result',))
+PHASE_SECONDS = METRICS.histogram('svs_phase_seconds', 'Time spent per processing phase', ('phase',))
+QUEUE_DEPTH = METRICS.gauge('svs_queue_depth', 'Slides found but not yet submitted to a worker')
+IN_FLIGHT = METRICS.gauge('svs_jobs_in_flight', 'Slides submitted to workers without a result')
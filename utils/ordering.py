@@ -0,0 +1,85 @@
+import os
+from pathlib import Path
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+# fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_HEADER = '=QQLLLL'
+# fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+FIEMAP_EXTENT = '=QQQ2QL3L'
+
+
+def physical_offset(path, logical_offset: int=0):
+    """Physical position on the device of the byte at logical_offset, from the FIEMAP ioctl.
+
+    Args:
+        path (str): path of the file
+        logical_offset (int, optional): byte of the file to look up. Defaults to 0.
+
+    Returns:
+        int | None: physical byte offset, None if FIEMAP is not supported (e.g. NFS or not Linux)
+    """
+    if fcntl is None:
+        return None
+    header = struct.pack(FIEMAP_HEADER, logical_offset, 1, 0, 0, 1, 0)
+    buffer = bytearray(header + bytes(struct.calcsize(FIEMAP_EXTENT)))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buffer, True)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    mapped_extents = struct.unpack_from(FIEMAP_HEADER, buffer)[3]
+    if mapped_extents == 0:
+        return None
+    fe_logical, fe_physical = struct.unpack_from(FIEMAP_EXTENT, buffer, struct.calcsize(FIEMAP_HEADER))[:2]
+    return fe_physical + max(logical_offset - fe_logical, 0)
+
+
+def locality_key(path, use_fiemap: bool=True):
+    """Sort key that places files close on disk next to each other: device, directory and then
+    the physical position of the end of the file (where the label and macro are), or the inode
+    number if the physical position is not available. A flag keeps the two kinds of position
+    apart, so files without a physical position sort before the others in their directory.
+
+    Returns:
+        tuple | None: sort key, None if the file cannot be read
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    position = None
+    if use_fiemap and stat.st_size:
+        position = physical_offset(path, stat.st_size - 1)
+    if position is not None:
+        return (stat.st_dev, str(Path(path).parent), True, position)
+    return (stat.st_dev, str(Path(path).parent), False, stat.st_ino)
+
+
+def locality_order(paths, use_fiemap: bool=True):
+    """Order in which to visit files so each disk is swept roughly sequentially.
+
+    Args:
+        paths (list): file paths
+        use_fiemap (bool, optional): use the physical position when available. Defaults to True.
+
+    Returns:
+        list: indices into paths. Files that cannot be read come last in their original order
+    """
+    keys = [locality_key(path, use_fiemap) for path in paths]
+    readable = sorted((key, index) for index, key in enumerate(keys) if key is not None)
+    missing = [index for index, key in enumerate(keys) if key is None]
+    return [index for _, index in readable] + missing
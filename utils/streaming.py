@@ -0,0 +1,258 @@
+import struct
+
+from .aperio import parse_image_description
+from .constants import BIG_TIFF, CLASSIC_TIFF, COMPRESSION, FORMAT_CHARACTERS
+
+# bytes kept back from the output before they are known to be safe to pass through
+STREAM_WINDOW = 32 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class StreamingDeidentifier():
+    def __init__(self, window: int=STREAM_WINDOW, chunk_size: int=STREAM_CHUNK_SIZE, replacement=None) -> None:
+        """Single pass de-identification of an SVS file read from a stream, e.g. stdin of a
+        transfer pipeline. The output is byte for byte what de_identify_slide (and, with a
+        replacement, LabelSwitcher without compaction) produces in place.
+
+        Bytes are passed through as soon as they cannot belong to the label or macro. The IFDs
+        are parsed as they stream past; the newest directory is held back until the next one is
+        read, because it may be the label. Once that next directory points further, the held back
+        directory cannot be the label. Data that lies before the IFD referencing it is only
+        recoverable while it is inside the window, so memory use is about window plus the size of
+        the label and macro, whatever the size of the slide.
+
+        Args:
+            window (int, optional): bytes held back before an IFD is seen. Defaults to 32 MiB.
+            chunk_size (int, optional): bytes read from the source at a time. Defaults to 1 MiB.
+            replacement (callable, optional): called with the label IFD offset and the TIFF layout
+            (BIG_TIFF or CLASSIC_TIFF); returns a list of (offset, bytes) written over the output
+            after the label and macro are zeroed. Defaults to None.
+        """
+        self.window = window
+        self.chunk_size = chunk_size
+        self.replacement = replacement
+        self._reset()
+
+    def _reset(self):
+        self.layout = None
+        self.label = None
+        self.macro = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.max_buffered = 0
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._next_ifd = None
+        self._directories = []
+        # (offset, bytes) written over the stream, known once the directory chain ends
+        self._edits = None
+
+    def run(self, source, sink):
+        """Copies source to sink with the label and macro zeroed (or replaced).
+
+        Args:
+            source: binary file-like object with read(size)
+            sink: binary file-like object with write(bytes)
+
+        Raises:
+            ValueError: If the stream is not a supported TIFF, the label or macro is not found, or
+            label or macro data was already passed through before its IFD was read
+
+        Returns:
+            dict: offsets and sizes of the label and macro, bytes read and written and the largest
+            number of bytes held in memory
+        """
+        self._reset()
+        while True:
+            chunk = source.read(self.chunk_size)
+            if chunk:
+                self.bytes_read += len(chunk)
+                self._append(chunk)
+            if self.layout is None:
+                if len(self._buffer) < BIG_TIFF['header_size'] and chunk:
+                    continue
+                self._read_header()
+            self._read_directories()
+            if not chunk:
+                break
+            self._emit(sink, self._emit_limit())
+
+        if self._edits is None:
+            raise ValueError('The stream ended before the last TIFF directory')
+        # the new label and macro may end after the original file
+        end = max([offset + len(data) for offset, data in self._edits] + [self._end])
+        if end > self._end:
+            self._append(bytes(end - self._end))
+        self._emit(sink, self._end)
+        sink.flush()
+
+        return {
+            'label': self.label,
+            'macro': self.macro,
+            'bytes read': self.bytes_read,
+            'bytes written': self.bytes_written,
+            'max buffered': self.max_buffered
+        }
+
+    @property
+    def _end(self):
+        return self._buffer_start + len(self._buffer)
+
+    def _append(self, data):
+        start = self._end
+        self._buffer.extend(data)
+        self.max_buffered = max(self.max_buffered, len(self._buffer))
+        if self._edits is not None:
+            self._apply_edits(start, self._end)
+
+    def _apply_edits(self, start, end):
+        for offset, data in self._edits:
+            low = max(offset, start)
+            high = min(offset + len(data), end)
+            if low < high:
+                self._buffer[low - self._buffer_start:high - self._buffer_start] = data[low - offset:high - offset]
+
+    def _emit(self, sink, limit):
+        count = limit - self._buffer_start
+        if count <= 0:
+            return
+        sink.write(bytes(self._buffer[:count]))
+        del self._buffer[:count]
+        self._buffer_start += count
+        self.bytes_written += count
+
+    def _emit_limit(self):
+        if self._edits is not None:
+            return self._end
+        limit = self._end - self.window
+        # an IFD that is only partly read
+        if self._next_ifd:
+            limit = min(limit, self._next_ifd)
+        # the newest directory may still turn out to be the label. The one before it is not, as
+        # the newest directory is not the last one (the macro) while the chain goes on
+        if self._directories and self._directories[-1]['strip'] is not None:
+            limit = min(limit, self._directories[-1]['region'][0])
+        return max(limit, self._buffer_start)
+
+    def _read_header(self):
+        header = bytes(self._buffer[:BIG_TIFF['header_size']])
+        if len(header) < CLASSIC_TIFF['header_size'] or header[:2] != b'II':
+            raise ValueError('The stream is not a little endian TIFF file')
+        version = struct.unpack_from('<H', header, 2)[0]
+        if version == CLASSIC_TIFF['version']:
+            self.layout = CLASSIC_TIFF
+            self._next_ifd = struct.unpack_from('<L', header, 4)[0]
+        elif version == BIG_TIFF['version'] and len(header) == BIG_TIFF['header_size']:
+            offset_size, reserved = struct.unpack_from('<HH', header, 4)
+            if offset_size != 8 or reserved != 0:
+                raise ValueError(f'Unsupported BigTIFF offset size {offset_size}')
+            self.layout = BIG_TIFF
+            self._next_ifd = struct.unpack_from('<Q', header, 8)[0]
+        else:
+            raise ValueError(f'Unsupported TIFF version {version}')
+
+    def _read_directories(self):
+        count_format = self.layout['count']
+        entry_format = self.layout['entry']
+        offset_format = self.layout['offset']
+        count_size = struct.calcsize(count_format)
+        entry_size = struct.calcsize(entry_format)
+        offset_size = struct.calcsize(offset_format)
+
+        while self._next_ifd and self._edits is None:
+            ifd_offset = self._next_ifd
+            if ifd_offset < self._buffer_start:
+                _error = (f'The IFD at {ifd_offset} lies before data that was already written to the output. '
+                    'The slide cannot be de-identified in one pass')
+                raise ValueError(_error)
+            if ifd_offset + count_size > self._end:
+                return
+            position = ifd_offset - self._buffer_start
+            entry_count = struct.unpack_from(count_format, self._buffer, position)[0]
+            ifd_size = count_size + entry_count * (entry_size + offset_size) + offset_size
+            if ifd_offset + ifd_size > self._end:
+                return
+
+            entries = {}
+            position += count_size
+            for _ in range(entry_count):
+                tag, ifd_type, ifd_count = struct.unpack_from(entry_format, self._buffer, position)
+                field = bytes(self._buffer[position + entry_size:position + entry_size + offset_size])
+                entries[tag] = (ifd_type, ifd_count, field, struct.unpack(offset_format, field)[0])
+                position += entry_size + offset_size
+            next_ifd = struct.unpack_from(offset_format, self._buffer, position)[0]
+
+            self._directories.append(self._directory(ifd_offset, ifd_size, entries, next_ifd))
+            self._next_ifd = next_ifd
+            if next_ifd == 0:
+                self._resolve()
+
+    def _directory(self, ifd_offset, ifd_size, entries, next_ifd):
+        region = [ifd_offset, ifd_offset + ifd_size]
+        # like BigTiffFile, the compression and single strip are read from the offset field
+        strip = None
+        if 273 in entries and 279 in entries and entries[273][1] == 1:
+            strip = (entries[273][3], entries[279][3])
+            region = [min(region[0], strip[0]), max(region[1], strip[0] + strip[1])]
+
+        description = None
+        if 270 in entries:
+            ifd_type, ifd_count, field, data_offset = entries[270]
+            length = struct.calcsize('<' + str(ifd_count) + FORMAT_CHARACTERS[ifd_type])
+            if length <= len(field):
+                description = field[:length]
+            else:
+                description = (data_offset, length)
+                region = [min(region[0], data_offset), max(region[1], data_offset + length)]
+
+        return {
+            'ifd offset': ifd_offset,
+            'compression': entries[259][3] if 259 in entries else None,
+            'strip': strip,
+            'strip count': entries[273][1] if 273 in entries else 0,
+            'description': description,
+            'region': tuple(region),
+            'next': next_ifd
+        }
+
+    def _image_type(self, directory):
+        description = directory['description']
+        if isinstance(description, tuple):
+            offset, length = description
+            if offset < self._buffer_start or offset + length > self._end:
+                return None
+            description = bytes(self._buffer[offset - self._buffer_start:offset + length - self._buffer_start])
+        if description is None:
+            return None
+        return parse_image_description(description)['image type']
+
+    def _resolve(self):
+        if len(self._directories) < 2:
+            raise ValueError('No label and macro found in the stream')
+        label_directory, macro_directory = self._directories[-2:]
+        for image_type, directory in (('label', label_directory), ('macro', macro_directory)):
+            if directory['strip count'] > 1:
+                _error = (f'The {image_type} is stored in {directory["strip count"]} strips. '
+                    'Streaming only supports single strip labels and macros, use de_identify_slide')
+                raise ValueError(_error)
+
+        if label_directory['strip'] is None or not (COMPRESSION.get(label_directory['compression']) == 'LZW'
+            or self._image_type(label_directory) == 'label'):
+            raise ValueError('No label found in the stream')
+        if macro_directory['strip'] is None or not (COMPRESSION.get(macro_directory['compression']) in ['JPEG', 'JPEG 7']
+            or self._image_type(macro_directory) == 'macro'):
+            raise ValueError('No macro found in the stream')
+
+        self.label = {'offset': label_directory['strip'][0], 'size': label_directory['strip'][1]}
+        self.macro = {'offset': macro_directory['strip'][0], 'size': macro_directory['strip'][1]}
+        edits = [(offset, bytes(byte_count)) for offset, byte_count in (label_directory['strip'], macro_directory['strip'])]
+        if self.replacement is not None:
+            edits.extend(self.replacement(label_directory['ifd offset'], self.layout))
+
+        for offset, data in edits:
+            if data and offset < self._buffer_start:
+                _error = (f'Label or macro data at {offset} was already written to the output. '
+                    f'Increase the window (currently {self.window} bytes)')
+                raise ValueError(_error)
+        self._edits = edits
+        self._apply_edits(self._buffer_start, self._end)
@@ -0,0 +1,33 @@
+class LazyTagInfo(dict):
+    def __init__(self, *args, loader=None, **kwargs) -> None:
+        """IFD entry of BigTiffFile.tiff_info. The 'value' key is decoded by loader(entry)
+        the first time it is read and then cached, so parsing a slide only reads the IFDs.
+
+        Args:
+            loader (callable, optional): returns the decoded value of the entry. Defaults to None.
+        """
+        super().__init__(*args, **kwargs)
+        self._loader = loader
+
+    def __missing__(self, key):
+        if key != 'value' or self._loader is None:
+            raise KeyError(key)
+        value = self._loader(self)
+        self['value'] = value
+        self._loader = None
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or (key == 'value' and self._loader is not None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def loaded(self):
+        """True once the value has been decoded
+        """
+        return super().__contains__('value')
@@ -2,7 +2,7 @@
 Useful resource: https://www.awaresystems.be/imaging/tiff/bigtiff.html
 '''
 
-from .constants import FORMAT_CHARACTERS
+from .constants import BIG_TIFF, CLASSIC_TIFF, FORMAT_CHARACTERS
 import io
 import numpy as np
 from PIL import Image
@@ -41,6 +41,15 @@ BIG_TIFF_LABEL_TEMPLATE = {
     296: {'type': 3, 'count': 1, 'value': (1,)},
 }
 
+# tags copied from the slide when a raw strip is wrapped in a classic TIFF
+RAW_TIFF_TAGS = (256, 257, 258, 259, 262, 277, 278, 284, 317)
+
+# 6 is old-style JPEG, 7 is JPEG. Aperio stores complete JPEG streams in both
+RAW_JPEG_COMPRESSION = (6, 7)
+
+# APP14 marker with transform 0 - tells decoders the JPEG data is RGB, not YCbCr
+ADOBE_RGB_MARKER = b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+
 
 class LabelSaver():
     def __init__(self) -> None:
@@ -156,9 +165,118 @@ class LabelSaver():
         self.img.seek(0)
 
 
+class RawImageSaver():
+    def __init__(self) -> None:
+        """Wraps the compressed strips of a label or macro in a minimal standalone
+        container without decoding them. JPEG compressed strips are saved as JPEG files
+        (merged with the JPEGTables when present), everything else is saved as a classic
+        TIFF with the same strips.
+        """
+        self.img = io.BytesIO()
+        self.extension = None
+
+    def save(self, strip_data, ifd_info: dict, jpeg_tables: bytes=None):
+        """Creates the container for the raw strips.
+
+        Args:
+            strip_data (bytes | list): compressed image data as stored in the slide, one bytes
+            object per strip
+            ifd_info (dict): directory information from BigTiffFile.tiff_info
+            jpeg_tables (bytes, optional): contents of tag 347. Defaults to None.
+
+        Raises:
+            ValueError: If JPEG compressed data is stored in more than one strip
+
+        Returns:
+            BytesIO: JPEG or TIFF file. The file extension is stored in self.extension
+        """
+        strips = [strip_data] if isinstance(strip_data, bytes) else list(strip_data)
+        compression = ifd_info[259]['value'][0]
+        if compression in RAW_JPEG_COMPRESSION:
+            if len(strips) != 1:
+                raise ValueError(f'Cannot save {len(strips)} JPEG strips as one JPEG file')
+            photometric = ifd_info.get(262, {}).get('value', (None,))[0]
+            self._write_jpeg(strips[0], jpeg_tables, photometric)
+            self.extension = '.jpg'
+        else:
+            self._write_tiff(strips, ifd_info)
+            self.extension = '.tif'
+        self.img.seek(0)
+        return self.img
+
+    def _write_jpeg(self, strip_data, jpeg_tables, photometric):
+        # abbreviated streams share their tables through tag 347. Both the tables and
+        # the strip are complete SOI...EOI streams, so the EOI of the tables and the SOI
+        # of the strip are dropped when merging them
+        if jpeg_tables:
+            strip_data = jpeg_tables[:-2] + strip_data[2:]
+
+        # RGB JPEG data is decoded as YCbCr unless an Adobe marker says otherwise
+        start_of_scan = strip_data.find(b'\xff\xda')
+        if photometric == 2 and strip_data.find(b'\xff\xee', 0, start_of_scan) == -1:
+            strip_data = strip_data[:2] + ADOBE_RGB_MARKER + strip_data[2:]
+
+        self.img.write(strip_data)
+
+    def _write_tiff(self, strips, ifd_info):
+        tags = {}
+        for tag in RAW_TIFF_TAGS:
+            if tag not in ifd_info:
+                continue
+            ifd_type = ifd_info[tag]['ifd_type']
+            tags[tag] = {
+                'type': 4 if ifd_type == 16 else ifd_type,
+                'count': ifd_info[tag]['ifd_count'],
+                'value': ifd_info[tag]['value']
+            }
+        if 278 not in tags:
+            tags[278] = {'type': 4, 'count': 1, 'value': ifd_info[257]['value']}
+        tags[273] = {'type': 4, 'count': len(strips), 'value': None}
+        tags[279] = {'type': 4, 'count': len(strips), 'value': tuple(len(strip) for strip in strips)}
+
+        num_entries = len(tags)
+        # 8 byte header, 2 byte entry count, 12 byte entries and 4 byte next IFD offset
+        extra_data_offset = 8 + 2 + num_entries * 12 + 4
+
+        self.img.write(b'II' + struct.pack('<HL', 42, 8))
+        self.img.write(struct.pack('<H', num_entries))
+
+        extra_data = b''
+        for tag in sorted(tags):
+            values = tags[tag]
+            fmt = '<' + str(values['count']) + FORMAT_CHARACTERS[values['type']]
+            if tag == 273:
+                strip_offsets = []
+                for strip in strips:
+                    strip_offsets.append(extra_data_offset + len(extra_data))
+                    extra_data += strip
+                    if len(extra_data) % 2 != 0:
+                        extra_data += b'\0'
+                values['value'] = tuple(strip_offsets)
+
+            self.img.write(struct.pack('<HHL', tag, values['type'], values['count']))
+            value = values['value']
+            if values['type'] in (2, 7) and isinstance(value, bytes):
+                value = tuple(value[i:i + 1] for i in range(len(value)))
+            data = struct.pack(fmt, *value)
+
+            if len(data) > struct.calcsize('<L'):
+                self.img.write(struct.pack('<L', extra_data_offset + len(extra_data)))
+                extra_data += data
+                if len(extra_data) % 2 != 0:
+                    extra_data += b'\0'
+            else:
+                self.img.write(data.ljust(struct.calcsize('<L'), b'\0'))
+
+        self.img.write(struct.pack('<L', 0))
+        self.img.write(extra_data)
+
+
 class BigTiffMaker():
-    def __init__(self, img_data: np.ndarray, label_or_macro: str, description: str=None) -> None:
+    def __init__(self, img_data: np.ndarray, label_or_macro: str, description: str=None, bigtiff: bool=True) -> None:
         self.label_or_macro = label_or_macro
+        # classic TIFF slides need a classic TIFF label and macro with 4 byte offsets
+        self.layout = BIG_TIFF if bigtiff else CLASSIC_TIFF
         self.img = io.BytesIO()
         self.img_data = img_data
 
@@ -169,12 +287,20 @@ class BigTiffMaker():
         self.img_data = img_data.tobytes()
         self.strip_byte_counts = len(self.img_data)
 
-        self.tiff_template = BIG_TIFF_LABEL_TEMPLATE.copy()
+        self.tiff_template = {tag: tag_info.copy() for tag, tag_info in BIG_TIFF_LABEL_TEMPLATE.items()}
+        if not bigtiff:
+            # LONG8 does not exist in classic TIFF
+            for tag_info in self.tiff_template.values():
+                if tag_info['type'] == 16:
+                    tag_info['type'] = 4
         
         self._update_tiff_template(description)
 
     def create_image(self):
-        header, offset = self._write_bigtiff_header()
+        if self.layout is CLASSIC_TIFF:
+            header, offset = self._write_classic_tiff_header()
+        else:
+            header, offset = self._write_bigtiff_header()
         
         self.img.write(header)
         self.img.seek(offset)
@@ -224,35 +350,49 @@ class BigTiffMaker():
         
         return header, first_ifd_offset
 
+    def _write_classic_tiff_header(self):
+        endian = 'II'.encode('UTF-8')
+        version = struct.pack('<H', 42)
+        first_ifd_offset = 8
+        initial_offset = struct.pack('<L', first_ifd_offset)
+        header = endian + version + initial_offset
+
+        return header, first_ifd_offset
+
 
     def _write_ifds(self):
 
         num_entries = len(self.tiff_template)
 
-        IFD_SIZE = 20 # each IFD is 20 bytes
-        NUM_ENTRIES_SIZE = 16 # number of entries stored as 8 bytes
-        NEXT_OFFSET_SIZE = 16 # the offset of the next directory is stored in 8 bytes
-        extra_data_offset = NUM_ENTRIES_SIZE + num_entries * IFD_SIZE + NEXT_OFFSET_SIZE
+        count_format = self.layout['count'] # number of entries
+        entry_format = self.layout['entry'] # tag, type and count of each entry
+        offset_format = self.layout['offset'] # value or offset of each entry and the next directory
+        offset_size = struct.calcsize(offset_format)
+        extra_data_offset = self.layout['header_size'] + struct.calcsize(count_format) + \
+            num_entries * (struct.calcsize(entry_format) + offset_size) + offset_size
 
-        self.img.write(struct.pack('<Q', num_entries))
+        self.img.write(struct.pack(count_format, num_entries))
 
-        for IFD_tag, tag_info in self.tiff_template.items(): #HHQQ
-            self.img.write(struct.pack('<H', IFD_tag))
-            self.img.write(struct.pack('<H', tag_info['type']))
-            self.img.write(struct.pack('<Q', tag_info['count']))
+        strip_offset_position = None
+        for IFD_tag, tag_info in self.tiff_template.items():
+            self.img.write(struct.pack(entry_format, IFD_tag, tag_info['type'], tag_info['count']))
 
             fmt = '<' + str(tag_info['count']) + FORMAT_CHARACTERS[tag_info['type']]
 
-            if struct.calcsize(fmt) > struct.calcsize('Q'):
+            if IFD_tag == 273:
+                # the image data goes after all other data, the offset is filled in below
+                strip_offset_position = self.img.tell()
+                self.img.seek(strip_offset_position + offset_size)
+
+            elif struct.calcsize(fmt) > offset_size:
+                data_to_write = tag_info.get('data', tag_info['value'])
                 tag_info['value'] = (extra_data_offset, )
 
-                self.img.write(struct.pack('<Q', *tag_info['value']))
+                self.img.write(struct.pack(offset_format, *tag_info['value']))
 
                 current_position = self.img.tell()
 
                 self.img.seek(extra_data_offset)
-
-                data_to_write = tag_info['data']
                 
                 self.img.write(struct.pack(fmt, *data_to_write))
 
@@ -268,15 +408,15 @@ class BigTiffMaker():
                 self.img.seek(current_position)
             
             else:
-                if IFD_tag == 273:
-                    self.tiff_template[273]['value'] = (extra_data_offset, )
-                    extra_data_offset += 16
-                distance_to_move = struct.calcsize('Q')
                 current_position = self.img.tell()
                 self.img.write(struct.pack(fmt, *tag_info['value']))
-                self.img.seek(current_position + distance_to_move)
+                self.img.seek(current_position + offset_size)
         if self.label_or_macro == 'macro':
-            self.img.write(struct.pack('<Q', 0))
-        self.img.seek(self.tiff_template[273]['value'][0])
+            self.img.write(struct.pack(offset_format, 0))
+
+        self.tiff_template[273]['value'] = (extra_data_offset, )
+        self.img.seek(strip_offset_position)
+        self.img.write(struct.pack(offset_format, extra_data_offset))
+        self.img.seek(extra_data_offset)
         self.img.write(self.img_data)
-        self.img.seek(0)
\ No newline at end of file
+        self.img.seek(0)
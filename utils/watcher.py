@@ -0,0 +1,214 @@
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, len - followed by len bytes of file name
+INOTIFY_EVENT = 'iIII'
+
+
+class InotifyWatch():
+    def __init__(self, directories) -> None:
+        """Minimal ctypes wrapper around Linux inotify. Reports files in the directories
+        that were closed after writing or moved into place.
+
+        Args:
+            directories (list): directories to watch
+
+        Raises:
+            OSError: If inotify is not available
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self._directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, os.strerror(errno), str(directory))
+            self._directories[wd] = Path(directory)
+        self.overflowed = False
+
+    def read(self, timeout: float):
+        """Waits up to timeout seconds for events.
+
+        Returns:
+            set: paths of the changed files
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        event_size = struct.calcsize(INOTIFY_EVENT)
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            position = 0
+            while position < len(data):
+                wd, mask, _, name_length = struct.unpack_from(INOTIFY_EVENT, data, position)
+                position += event_size
+                name = data[position:position + name_length].rstrip(b'\0')
+                position += name_length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                elif wd in self._directories and name:
+                    changed.add(self._directories[wd].joinpath(os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher():
+    def __init__(self, directories, pattern: str='*.svs', poll_interval: float=5.0, settle_seconds: float=10.0,
+        is_complete=None, use_inotify: bool=True) -> None:
+        """Finds files that are completely written in a set of directories. A file is ready
+        once its size and modification time have not changed for settle_seconds and
+        is_complete (e.g. a check of the TIFF directory chain) accepts it.
+
+        Changes are picked up with inotify on Linux and by rescanning the directories every
+        poll_interval seconds everywhere else (or on network file systems with use_inotify=False).
+        Files that are already present when the watcher starts are treated as new.
+
+        Args:
+            directories (list): directories to watch
+            pattern (str, optional): glob pattern of the files to report. Defaults to '*.svs'.
+            poll_interval (float, optional): seconds between checks. Defaults to 5.0.
+            settle_seconds (float, optional): seconds a file must be unchanged. Defaults to 10.0.
+            is_complete (callable, optional): called with the path of a settled file; returns False
+            to keep waiting. Defaults to None.
+            use_inotify (bool, optional): use inotify when available. Defaults to True.
+        """
+        self.directories = [Path(directory) for directory in directories]
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.is_complete = is_complete
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = InotifyWatch(self.directories)
+            except (OSError, AttributeError):
+                self._inotify = None
+
+        # path: (size, mtime_ns, time the current size was first seen)
+        self._pending = {}
+        # path: (size, mtime_ns) when the file was reported or processed
+        self._seen = {}
+        self._rescan = True
+
+    @property
+    def mode(self):
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    @property
+    def pending(self):
+        """Number of files that are still being written or settling
+        """
+        return len(self._pending)
+
+    def poll(self, timeout: float=None):
+        """Waits for changes and returns the files that became ready.
+
+        Args:
+            timeout (float, optional): maximum seconds to wait. Defaults to poll_interval.
+
+        Returns:
+            list: paths of the files that are ready to process
+        """
+        timeout = self.poll_interval if timeout is None else timeout
+        if self._inotify is not None and not self._rescan:
+            changed = self._inotify.read(timeout)
+            if self._inotify.overflowed:
+                self._inotify.overflowed = False
+                changed |= self._scan()
+        else:
+            if not self._rescan:
+                time.sleep(timeout)
+            changed = self._scan()
+            self._rescan = False
+
+        for path in changed:
+            if path.match(self.pattern):
+                self._pending.setdefault(path, None)
+        return self._check_pending()
+
+    def mark_processed(self, path):
+        """Records the current state of a file so changes made while processing it
+        are not reported as a new file.
+        """
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self._seen.pop(path, None)
+            return
+        self._seen[path] = (stat.st_size, stat.st_mtime_ns)
+        self._pending.pop(path, None)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _scan(self):
+        found = set()
+        for directory in self.directories:
+            found.update(directory.glob(self.pattern))
+        return found
+
+    def _check_pending(self):
+        ready = []
+        now = time.monotonic()
+        for path, previous in list(self._pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(path) == state:
+                del self._pending[path]
+                continue
+            if previous is None or previous[:2] != state:
+                self._pending[path] = state + (now,)
+                continue
+            if now - previous[2] < self.settle_seconds:
+                continue
+            if self.is_complete is not None and not self.is_complete(path):
+                # restart the settle time so incomplete files are not rechecked on every poll
+                self._pending[path] = state + (now,)
+                continue
+
+            del self._pending[path]
+            self._seen[path] = state
+            ready.append(path)
+        return ready
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()